@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark for the JS -> Python call path of widget APIs.
+
+Measures the work done per call before the exposed method is handed to its
+thread: looking the method up on the `PyToJSInterface` and separating the
+callback from the arguments. The former behaviour (`API.__getattribute__`
+wrapping every exposed method in a new `Proxy`, which ran
+``inspect.getargspec`` on every call) is compared with the dispatch table.
+Starting the thread costs the same in both cases and is left out. Needs
+PyGObject, like Melange itself. Run from the repository root::
+
+    python benchmarks/bench_api_calls.py
+"""
+
+import os
+import sys
+import time
+import inspect
+import weakref
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from melange import api
+
+DURATION = 1.0
+ARGS = ('feed', 10, lambda result: None)
+
+
+class Context(object):
+    pass
+
+
+class WeatherAPI(api.API):
+
+    def helper(self):
+        pass
+
+    @api.expose
+    def get_items(self, feed, count):
+        return []
+
+
+class LegacyProxy(object):
+
+    def __init__(self, obj, ctx):
+        self.obj = obj
+        self.ctx_ref = weakref.ref(ctx)
+        self.event = None
+
+    def split_args(self, *args):
+        args = list(args)
+        func_args = inspect.getargspec(self.obj).args
+        if (len(func_args) == len(args) and func_args[0] != 'self') or len(func_args) > len(args):
+            callback = None
+        else:
+            callback = args.pop(-1)
+        return args, callback
+
+
+class LegacyWeatherAPI(WeatherAPI):
+
+    def __getattribute__(self, obj_name):
+        obj = object.__getattribute__(self, obj_name)
+        if getattr(obj, '_callable', None) == True:
+            return LegacyProxy(obj, self._js_ctx)
+        return obj
+
+
+class LegacyInterface(object):
+
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, obj_name):
+        obj = getattr(self.api, obj_name)
+        if isinstance(obj, LegacyProxy):
+            return obj
+        raise AttributeError
+
+
+def legacy_call(interface):
+    interface.get_items.split_args(*ARGS)
+
+
+def table_call(interface):
+    interface.get_items.split_args(ARGS)
+
+
+def measure(func, interface):
+
+    count = 0
+    start = time.time()
+    while time.time() - start < DURATION:
+        for _ in xrange(1000):
+            func(interface)
+        count += 1000
+    return count / (time.time() - start)
+
+
+def main():
+
+    ctx = Context()
+    WeatherAPI._js_ctx = ctx
+    LegacyWeatherAPI._js_ctx = ctx
+
+    before = measure(legacy_call, LegacyInterface(LegacyWeatherAPI()))
+    after = measure(table_call, api.PyToJSInterface(WeatherAPI()))
+
+    print '{0:>16} {1:>16} {2:>8}'.format('before calls/s', 'after calls/s', 'speedup')
+    print '{0:>16.0f} {1:>16.0f} {2:>7.1f}x'.format(before, after, after / before)
+
+
+if __name__ == '__main__':
+    main()
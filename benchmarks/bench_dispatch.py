@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark for the request routing of `SmallWebFramework`.
+
+Compares the former per-request work (``parse_qs`` on every query string and
+trying every route's regex in turn) with the compiled dispatcher for a
+growing number of routes. Run from the repository root::
+
+    python benchmarks/bench_dispatch.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from melange.httpserver import SmallWebFramework, QueryString, route, query_string_to_dict
+
+QUERY_STRING = 'instance=0123456789abcdef0123456789abcdef'
+DURATION = 1.0
+
+
+def make_framework(route_count):
+
+    attrs = {}
+    for i in xrange(route_count):
+        def handler(self, GET, file):
+            return file
+        attrs['route_%03d' % i] = route(r'/prefix%03d/(?P<file>.*)' % i)(handler)
+    return type('Framework%d' % route_count, (SmallWebFramework,), attrs)()
+
+
+def legacy_routing(framework, environ):
+
+    GET = query_string_to_dict(environ.get('QUERY_STRING', ''))
+    path = environ.get('PATH_INFO', '')
+    for func in framework.routed_methods:
+        for r in func.__bjoern_routes__:
+            match = r.match(path)
+            if match is not None:
+                return GET, func, match.groupdict()
+    return GET, None, None
+
+
+def compiled_routing(framework, environ):
+
+    GET = QueryString(environ.get('QUERY_STRING', ''))
+    GET.get('instance')
+    func, kwargs = framework.dispatch(environ)
+    return GET, func, kwargs
+
+
+def measure(func, framework, environs):
+
+    count = 0
+    start = time.time()
+    while time.time() - start < DURATION:
+        for environ in environs:
+            func(framework, environ)
+        count += len(environs)
+    return count / (time.time() - start)
+
+
+def main():
+
+    print '{0:>7} {1:>14} {2:>14} {3:>8}'.format('routes', 'before req/s', 'after req/s', 'speedup')
+    for route_count in (4, 16, 64, 256):
+        framework = make_framework(route_count)
+        environs = [
+            {'PATH_INFO': '/prefix%03d/some/file.js' % i, 'QUERY_STRING': QUERY_STRING}
+            for i in xrange(route_count)
+        ]
+        before = measure(legacy_routing, framework, environs)
+        after = measure(compiled_routing, framework, environs)
+        print '{0:>7} {1:>14.0f} {2:>14.0f} {3:>7.1f}x'.format(route_count, before, after, after / before)
+
+
+if __name__ == '__main__':
+    main()
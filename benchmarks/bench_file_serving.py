@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for serving a large file through `SmallWebFramework`.
+
+Serves a 50 MB file of random bytes and writes the response body to
+/dev/null, comparing the former behaviour (returning the bare `file`, which
+the server iterates line by line) with block iteration and with
+``wsgi.file_wrapper``. Run from the repository root::
+
+    python benchmarks/bench_file_serving.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+from wsgiref.util import FileWrapper
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from melange.httpserver import SmallWebFramework, route
+
+FILE_SIZE = 50 * 1024 * 1024
+ROUNDS = 3
+
+
+class FileServer(SmallWebFramework):
+
+    def __init__(self, path):
+        SmallWebFramework.__init__(self)
+        self.path = path
+
+    @route(r'/data/(?P<file>.*)')
+    def data_files(self, GET, file):
+        return open(self.path, 'rb')
+
+
+def drain(body, fd):
+
+    try:
+        for chunk in body:
+            os.write(fd, chunk)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def serve(server, environ, fd):
+
+    body = server(environ, lambda status, headers, exc_info=None: None)
+    drain(body, fd)
+
+
+def serve_legacy(server, environ, fd):
+
+    drain(open(server.path, 'rb'), fd)
+
+
+def measure(func, server, environ, fd):
+
+    best = None
+    for _ in xrange(ROUNDS):
+        start = time.time()
+        func(server, environ, fd)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+
+    handle, path = tempfile.mkstemp(prefix='melange-bench-')
+    try:
+        with os.fdopen(handle, 'wb') as file_:
+            for _ in xrange(FILE_SIZE / (1024 * 1024)):
+                file_.write(os.urandom(1024 * 1024))
+
+        server = FileServer(path)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+
+        cases = [
+            ('bare file (before)', serve_legacy, {}),
+            ('block iteration', serve, {}),
+            ('wsgi.file_wrapper', serve, {'wsgi.file_wrapper': FileWrapper}),
+        ]
+
+        print '{0:<20} {1:>10} {2:>10}'.format('', 'seconds', 'MB/s')
+        for name, func, extra in cases:
+            environ = {'PATH_INFO': '/data/large.bin', 'QUERY_STRING': ''}
+            environ.update(extra)
+            elapsed = measure(func, server, environ, devnull)
+            print '{0:<20} {1:>10.3f} {2:>10.0f}'.format(name, elapsed, FILE_SIZE / elapsed / 1024 / 1024)
+
+        os.close(devnull)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WSGI-level benchmark for `HttpServer`.
+
+Calls `HttpServer.__call__` directly with synthetic environs, against a stub
+of the `Melange` object and fixture common, theme, skin and data trees built
+in a temporary directory (the common and theme files are copied from
+``src/data``). Needs neither a display nor the network. For every case,
+requests/second and the median and 99th percentile latency (including
+draining the response body) are reported. Run from the repository root::
+
+    python benchmarks/bench_httpserver.py [--duration SECONDS] [--instances N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from wsgiref.util import FileWrapper
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+from melange.assets import ContentIndex
+from melange.httpserver import HttpServer
+
+SMALL_FILE_SIZE = 4 * 1024
+LARGE_FILE_SIZE = 8 * 1024 * 1024
+
+SKIN = '''<html>
+<head>
+    <script type="text/javascript" src="/common/core/mootools.js"></script>
+    <script type="text/javascript" src="/common/core/mootools-more.js"></script>
+    <script type="text/javascript" src="/common/core/melange.js"></script>
+    <script type="text/javascript" src="/theme/ui/scrolled/scrolled.js"></script>
+    <script type="text/javascript" src="skin.js"></script>
+    <link rel="stylesheet" type="text/css" href="/theme/ui/melange.css" />
+    <link rel="stylesheet" type="text/css" href="/theme/ui/scroll/scroll.css" />
+</head>
+<body>
+    <div class="widget"><img src="/theme/ui/scrolled/images/up.png" /></div>
+</body>
+</html>
+'''
+
+
+class Theme(dict):
+    pass
+
+
+class Themes(object):
+
+    def __init__(self, themes):
+        self.themes = themes
+
+    def get(self, id=None):
+        return iter([theme for theme in self.themes if id in (None, theme['id'])])
+
+
+class Context(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self):
+        return self.path
+
+    def get_user_path(self):
+        return self.path
+
+
+class Config(object):
+    default_theme = 'default'
+    http_backend = 'threaded'
+    inprocess_resources = False
+    bundle_assets = True
+    trim_libraries = False
+    compile_skins = True
+    proxy_external_resources = False
+
+
+class Widget(object):
+
+    def __init__(self, instance_id, root, theme):
+        self.instance_id = instance_id
+        self.root = root
+        self.theme = theme
+
+    def get_skin_path(self):
+        return os.path.join(self.root, 'skin')
+
+    def get_data_path(self):
+        return os.path.join(self.root, 'data')
+
+    def get_current_theme(self):
+        return self.theme
+
+
+class StubMelange(object):
+    """ Provides what `HttpServer` uses of `Melange`. """
+
+    def __init__(self, root, instances):
+
+        self.context = Context(root)
+        self.config = Config()
+
+        themes = [Theme(id=name, name=name, path=os.path.join(root, 'data/themes', name))
+                  for name in ('default', 'light')]
+        self.themes = Themes(themes)
+        self.theme_contents = ContentIndex()
+        for theme in themes:
+            self.theme_contents.scan(theme['path'])
+
+        self.widgets = {}
+        for i in xrange(instances):
+            instance_id = '%032x' % i
+            self.widgets[instance_id] = Widget(instance_id, root, themes[i % len(themes)])
+
+
+def make_fixtures(root):
+
+    os.makedirs(os.path.join(root, 'data'))
+    shutil.copytree(os.path.join(SRC, 'data/common'), os.path.join(root, 'data/common'))
+    shutil.copytree(os.path.join(SRC, 'data/themes'), os.path.join(root, 'data/themes'))
+
+    os.makedirs(os.path.join(root, 'skin'))
+    with open(os.path.join(root, 'skin/index.html'), 'w') as file_:
+        file_.write(SKIN)
+    with open(os.path.join(root, 'skin/skin.js'), 'w') as file_:
+        file_.write('function main() { $$(".widget").set("text", "Hello"); }\n')
+
+    with open(os.path.join(root, 'data/small.bin'), 'wb') as file_:
+        file_.write(os.urandom(SMALL_FILE_SIZE))
+    with open(os.path.join(root, 'data/large.bin'), 'wb') as file_:
+        for _ in xrange(LARGE_FILE_SIZE / (1024 * 1024)):
+            file_.write(os.urandom(1024 * 1024))
+
+
+def make_environ(path, query_string='', **extra):
+
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+    }
+    environ.update(extra)
+    return environ
+
+
+def request(server, environ):
+    """ Serve `environ` like a server would and return the response's status. """
+
+    response = []
+    body = server(dict(environ), lambda status, headers, exc_info=None: response.append(status))
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return response[0]
+
+
+def percentile(sorted_values, fraction):
+
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def measure(server, environs, duration):
+
+    # Warm up caches the way a running server would have them.
+    for environ in environs:
+        request(server, environ)
+
+    latencies = []
+    statuses = set()
+    start = time.time()
+    while time.time() - start < duration:
+        for environ in environs:
+            t = time.time()
+            statuses.add(request(server, environ))
+            latencies.append(time.time() - t)
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return (len(latencies) / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99),
+            ', '.join(sorted(status.split(' ', 1)[0] for status in statuses)))
+
+
+def make_cases(melange):
+
+    instances = sorted(melange.widgets)
+    instance = 'instance=' + instances[0]
+    page = make_environ('/widget/index.html', instance)
+
+    server = HttpServer(melange)
+    request(server, page)
+    etag = dict(_get_headers(server, make_environ('/common/core/melange.js', instance)))['ETag']
+
+    return [
+        ('widget page', [page]),
+        ('widget page, {0} instances'.format(len(instances)),
+            [make_environ('/widget/index.html', 'instance=' + i) for i in instances]),
+        ('skin file', [make_environ('/widget/skin.js', instance)]),
+        ('common, small', [make_environ('/common/core/melange.js', instance)]),
+        ('common, large', [make_environ('/common/core/mootools.js', instance)]),
+        ('common, gzip', [make_environ('/common/core/mootools.js', instance,
+                                       HTTP_ACCEPT_ENCODING='gzip')]),
+        ('common, 304', [make_environ('/common/core/melange.js', instance, HTTP_IF_NONE_MATCH=etag)]),
+        ('theme file', [make_environ('/theme/ui/melange.css', instance)]),
+        ('theme file, {0} instances'.format(len(instances)),
+            [make_environ('/theme/ui/melange.css', 'instance=' + i) for i in instances]),
+        ('data, small', [make_environ('/data/small.bin', instance)]),
+        ('data, large', [make_environ('/data/large.bin', instance)]),
+        ('data, large, file_wrapper', [make_environ('/data/large.bin', instance,
+                                                    **{'wsgi.file_wrapper': FileWrapper})]),
+        ('data, range', [make_environ('/data/large.bin', instance, HTTP_RANGE='bytes=0-65535')]),
+        ('404, no route', [make_environ('/nonexistent', instance)]),
+        ('missing file', [make_environ('/common/nonexistent.js', instance)]),
+        ('stats', [make_environ('/_stats')]),
+    ]
+
+
+def _get_headers(server, environ):
+
+    response = []
+    body = server(environ, lambda status, headers, exc_info=None: response.append(headers))
+    if hasattr(body, 'close'):
+        body.close()
+    return response[0]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark HttpServer at the WSGI level.')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds to run each case for (default: %(default)s)')
+    parser.add_argument('--instances', type=int, default=100,
+                        help='number of distinct widget instances (default: %(default)s)')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='melange-bench-')
+    try:
+        make_fixtures(root)
+        melange = StubMelange(root, max(1, args.instances))
+
+        print '{0:<30} {1:>10} {2:>10} {3:>10}  {4}'.format('', 'req/s', 'p50 ms', 'p99 ms', 'status')
+        for name, environs in make_cases(melange):
+            # Every case starts out with a fresh server, so caches and
+            # statistics of one case don't influence the next.
+            server = HttpServer(melange)
+            rate, p50, p99, statuses = measure(server, environs, args.duration)
+            print '{0:<30} {1:>10.0f} {2:>10.3f} {3:>10.3f}  {4}'.format(
+                name, rate, p50 * 1000, p99 * 1000, statuses)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
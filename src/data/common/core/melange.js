@@ -45,7 +45,16 @@ var ConfigurationWrapper = new Class({
 
 var Widget = new Class({
     init: function() {
-        _python.init();
+        var events_url = _python.init();
+        if(events_url && window.EventSource !== undefined) {
+            /* Events published by the Python API: */
+            var api = this.api;
+            this.events = new EventSource(events_url);
+            this.events.onmessage = function(message) {
+                var event = JSON.decode(message.data);
+                api.fireEvent(event.event, [event.data]);
+            };
+        }
     },
     api: new API(),
     config: new ConfigurationWrapper()
@@ -17,6 +17,7 @@
 # MA 02110-1301, USA.
 
 import os
+import json
 import thread
 from operator import itemgetter
 
@@ -36,8 +37,10 @@ from gpyconf.fields import MultiOptionField
 
 from melange.dialogs import AddWidgetDialog
 
+from melange import api
 from melange.widget import Widget
 from melange.httpserver import HttpServer
+from melange.assets import ContentIndex
 from melange.hotkeys import HotkeyRecorder
 from melange.common import HTTPSERVER_HOST, HTTPSERVER_PORT, OVERLAY_FADE_DURATION, \
                             STATE_NONE, STATE_MOVE, STATE_MOVING, MOUSE_BUTTON_LEFT, \
@@ -355,9 +358,11 @@ class Melange(cream.Module, cream.ipc.Object):
             '/org/cream/Melange'
         )
 
-        self.run_server()
-
         self.widgets = WidgetManager()
+        self.widgets.connect('widget-added', lambda manager, widget: self.server.readiness.set_ready(widget.instance_id))
+        self.widgets.connect('widget-removed', lambda manager, widget: self.server.readiness.forget(widget.instance_id))
+        self.widgets.connect('widget-removed', lambda manager, widget: self.server.events.close(widget.instance_id))
+        self.widgets.connect('widget-removed', lambda manager, widget: self.server.stats.forget(widget.instance_id))
 
         self.widgets.primary_widget_layer.connect('button-release-event', self.button_release_cb)
 
@@ -368,6 +373,11 @@ class Melange(cream.Module, cream.ipc.Object):
             ]
         self.themes = cream.manifest.ManifestDB(theme_dirs, type='org.cream.melange.Theme')
 
+        # Themes often ship identical files, which are served only once.
+        self.theme_contents = ContentIndex()
+        for theme in self.themes.get():
+            self.theme_contents.scan(theme['path'])
+
         self.config._add_field(
             'default_theme',
             MultiOptionField('Default Theme',
@@ -378,6 +388,8 @@ class Melange(cream.Module, cream.ipc.Object):
         self.config.read()
         self.config.connect('field-value-changed', self.configuration_value_changed_cb)
 
+        self.run_server()
+
         self.hotkeys.connect('hotkey-activated', self.hotkey_activated_cb)
 
         widget_dirs = [
@@ -446,8 +458,15 @@ class Melange(cream.Module, cream.ipc.Object):
 
 
     def run_server(self):
-        server = HttpServer(self)
-        thread.start_new_thread(server.run, (HTTPSERVER_HOST, HTTPSERVER_PORT))
+        self.server = HttpServer(self)
+        if self.config.inprocess_resources:
+            # Widgets load their resources using `HttpServer.fetch`, except
+            # for files below /data and large files. Those are served on a
+            # free port, so several sessions don't compete for the same one.
+            self.server.start(HTTPSERVER_HOST)
+            return
+        thread.start_new_thread(self.server.run, (HTTPSERVER_HOST, HTTPSERVER_PORT,
+                                                  self.config.http_backend))
 
 
     def add_widget(self):
@@ -517,6 +536,32 @@ class Melange(cream.Module, cream.ipc.Object):
         return res
 
 
+    @cream.ipc.method('', 's')
+    def get_server_stats(self):
+        """
+        Get the statistics of the HTTP server serving the widgets.
+
+        :return: JSON encoded statistics per route and widget instance.
+        :rtype: `str`
+        """
+
+        return json.dumps(self.server.get_stats(), sort_keys=True)
+
+
+    @cream.ipc.method('', 's')
+    def get_api_stats(self):
+        """
+        Get the statistics of the worker pool running exposed API methods
+        and of the caches of their results.
+
+        :return: JSON encoded queue depth, running calls, wait times and
+                 cache hits and misses.
+        :rtype: `str`
+        """
+
+        return json.dumps(api.get_stats(), sort_keys=True)
+
+
     @cream.ipc.method('','')
     def toggle_overlay(self):
 
@@ -16,128 +16,405 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
+import json
 import inspect
 import os.path
 import weakref
 import gobject
 import threading
 import tempfile
+import itertools
+import functools
 from collections import defaultdict
 
+from melange.workers import WorkerPool, InflightCalls, PoolFull
+from melange.results import ResultCache, MISSING
+
 APIS = defaultdict(dict)
 
+# The threads exposed methods are run in:
+WORKER_POOL = WorkerPool()
+
+# The `ResultCache` objects of exposed methods, by `get_method_id`. Widgets
+# load their API module once per instance, so the classes differ:
+RESULT_CACHES = defaultdict(weakref.WeakSet)
+# The caches of methods exposed with ``shared_cache=True``:
+SHARED_RESULT_CACHES = {}
+_result_caches_lock = threading.Lock()
+
+# Calls of methods exposed with ``coalesce=True`` that are running:
+INFLIGHT_CALLS = InflightCalls()
+
+# Source of the ids distinguishing concurrent calls:
+CALL_IDS = itertools.count(1)
+
+# Modes exposed methods can be executed in:
+MODE_THREAD = 'thread'
+MODE_MAIN = 'main'
+
+
+class ExposedMethod(object):
+    """ What is needed to call an exposed method from JS. """
+
+    __slots__ = ('name', 'arity', 'mode', 'cache_options', 'method_id', 'coalesce')
+
+    def __init__(self, name, arity, mode, cache_options=None, method_id=None, coalesce=False):
+
+        self.name = name
+        # JS passes a callback after the method's own arguments:
+        self.arity = arity
+        self.mode = mode
+        # Arguments of the method's `ResultCache`, see `get_result_cache`:
+        self.cache_options = cache_options
+        # What identifies the method across widget instances, see `get_method_id`:
+        self.method_id = method_id
+        # Whether identical calls are joined:
+        self.coalesce = coalesce
+
+
+def build_dispatch_table(cls):
+    """
+    Collect the exposed methods of the API class `cls`.
+
+    :return: A `dict` mapping method names to `ExposedMethod` objects.
+    :raises ValueError: If `cls` exposes a method named ``batch``, see
+                        `PyToJSInterface.batch`.
+    """
+
+    table = {}
+    for name in dir(cls):
+        attr = getattr(cls, name, None)
+        func = getattr(attr, 'im_func', attr)
+        if not getattr(func, '_callable', False):
+            continue
+        arity = len(inspect.getargspec(func).args)
+        if hasattr(attr, 'im_func'):
+            # `self` (or `cls`) isn't passed by JS.
+            arity -= 1
+        cache_options = getattr(func, '_cache_options', None)
+        coalesce = getattr(func, '_coalesce', False)
+        method_id = get_method_id(cls, name) if cache_options is not None or coalesce else None
+        table[name] = ExposedMethod(name, arity, getattr(func, '_mode', MODE_THREAD),
+                                    cache_options, method_id, coalesce)
+    if 'batch' in table:
+        raise ValueError('{0} exposes `batch`, which is reserved for batch calls'.format(cls.__name__))
+    return table
+
+
+def get_method_id(cls, name):
+    """
+    Identify the method `name` of the API class `cls` by the API's source
+    file, the class' and the method's name. Unlike the class itself, this
+    is the same for all widget instances.
+    """
+
+    return (os.path.abspath(inspect.getsourcefile(cls)), cls.__name__, name)
+
+
+def get_result_cache(api, exposed):
+    """
+    Get the `ResultCache` of the exposed method `exposed` of the API object
+    `api`. Unless the method is exposed with ``shared_cache=True``, every API
+    object has caches of its own.
+
+    :return: The cache or `None` if the method's results aren't cached.
+    """
+
+    if exposed.cache_options is None:
+        return None
+
+    caches = api.__dict__.setdefault('_result_caches', {})
+    cache = caches.get(exposed.name)
+    if cache is None:
+        options = dict(exposed.cache_options)
+        shared = options.pop('shared')
+        with _result_caches_lock:
+            if shared:
+                cache = SHARED_RESULT_CACHES.get(exposed.method_id)
+                if cache is None:
+                    cache = SHARED_RESULT_CACHES[exposed.method_id] = ResultCache(**options)
+            else:
+                cache = ResultCache(**options)
+            RESULT_CACHES[exposed.method_id].add(cache)
+        caches[exposed.name] = cache
+    return cache
+
+
+def to_list(value):
+    """ Convert a JS array (or a Python sequence) to a `list`. """
+
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value[index] for index in xrange(int(value.length))]
+
+
+def get_dispatch_table(cls):
+    """ Get the dispatch table of the API class `cls`, building it if necessary. """
+
+    table = cls.__dict__.get('_dispatch_table')
+    if table is None:
+        table = build_dispatch_table(cls)
+        cls._dispatch_table = table
+    return table
+
+
 class Proxy(object):
     """
-    A proxy for wrapping functions to run them in threads.
-    This object registers potential callback functions
-    and calls them using Mootools' Events.
+    A proxy for calling an exposed method from JS. Depending on the method's
+    mode, it is run by the `WORKER_POOL` or in the main loop. The result is
+    passed to the callback given as last argument (if any) using Mootools'
+    Events. Every call registers its callback under an event of its own
+    (``<name>:<call id>``), so concurrent calls get their own results.
     """
 
-    def __init__(self, obj, ctx):
+    __slots__ = ('method', 'exposed', 'ctx_ref', 'owner', 'cache')
+
+    def __init__(self, method, exposed, ctx, owner):
         """
         Initialize the Proxy object.
 
-        :param obj: The function to wrap.
+        :param method: The bound method to wrap.
+        :param exposed: The method's `ExposedMethod`.
         :param ctx: A JavaScriptCore context.
+        :param owner: The API object, whose calls share a concurrency limit.
         """
 
-        self.obj = obj
+        self.method = method
+        self.exposed = exposed
         self.ctx_ref = weakref.ref(ctx)
+        self.owner = owner
+        self.cache = get_result_cache(owner, exposed)
+
+
+    def split_args(self, args):
+        """ Separate the callback from the arguments passed by JS. """
 
-        self.event = None
+        if len(args) > self.exposed.arity:
+            return args[:-1], args[-1]
+        return args, None
 
 
     def __call__(self, *args):
-        """ Call the wrapped function in another thread. """
+        """
+        Call the wrapped method in a worker thread or the main loop.
+
+        :raises PoolFull: If too many calls are waiting for a worker.
+        """
 
-        # Get callback function...
-        args = list(args)
+        args, callback = self.split_args(args)
+        event = '{0}:{1}'.format(self.exposed.name, CALL_IDS.next()) if callback else None
 
-        func_args = inspect.getargspec(self.obj).args
-        if (len(func_args) == len(args) and func_args[0] != 'self') or len(func_args) > len(args):
-            callback = None
+        func, data = self.lookup(args)
+
+        if func is None:
+            if event:
+                gobject.idle_add(self._finish, event, data)
+        elif self.exposed.mode == MODE_MAIN:
+            gobject.idle_add(self._run_in_main_loop, func, args, event)
         else:
-            callback = args.pop(-1)
+            done = None
+            if event:
+                done = lambda data: gobject.idle_add(self._finish, event, data)
+            call = self._get_call(args)
+            if call is None:
+                WORKER_POOL.submit(self.owner, func, args, done)
+            elif INFLIGHT_CALLS.join(call, done):
+                try:
+                    WORKER_POOL.submit(self.owner, func, args,
+                                       functools.partial(INFLIGHT_CALLS.finish, call))
+                except PoolFull:
+                    INFLIGHT_CALLS.discard(call)
+                    raise
+
+        # Register callback function (the result is passed in the main loop,
+        # so this happens before):
+        if event:
+            self.ctx_ref().widget.api.addEvent(event, callback)
+
+
+    def lookup(self, args):
+        """
+        Look up the result of a call with the arguments `args` in the
+        method's cache.
+
+        :return: The function to call with `args` for computing the result
+                 (`None` if it is cached) and the cached result (`MISSING`
+                 if it isn't).
+        """
+
+        cache = self.cache
+        key = cache.make_key(args) if cache is not None else None
+        if key is None:
+            return self.method, MISSING
+        data = cache.get(key)
+        if data is not MISSING:
+            return None, data
+        return functools.partial(self._call_cached, cache, key), MISSING
+
+
+    def _get_call(self, args):
+        """ Get what identical calls of the method have in common, if they may be joined. """
+
+        if not self.exposed.coalesce:
+            return None
+        call = self.exposed.method_id + (args,)
+        try:
+            hash(call)
+        except TypeError:
+            return None
+        return call
 
-        # Initialize thread:
-        call_thread = Thread(self.obj, args)
 
-        # Register callback function:
-        if callback:
-            ctx = self.ctx_ref()
-            self.event = self.obj.__name__
-            ctx.widget.api.addEvent(self.event, callback)
-            call_thread.connect('finished', lambda thread, data: self.fire_event(self.obj.__name__, data))
+    def _finish(self, event, data):
+        self.fire_event(event, data)
+        return False
 
-        # Start thread:
-        call_thread.start()
+
+    def _call_cached(self, cache, key, *args):
+
+        ret = self.method(*args)
+        cache.put(key, ret)
+        return ret
+
+
+    def _run_in_main_loop(self, func, args, event):
+
+        try:
+            ret = func(*args)
+        except Exception, e:
+            import traceback
+            traceback.print_exc()
+            ret = None
+        if event:
+            self.fire_event(event, ret)
+        return False
 
 
     def fire_event(self, event, data):
         """
-        Fire the given event.
+        Pass the result of a call to its callback.
 
-        :param event: Name of the event to fire.
+        :param event: The call's event, as registered by `__call__`.
         :param data: Data to emit with the event.
         """
 
         ctx = self.ctx_ref()
-        if self.event:
-            ctx.widget.api.fireEvent(self.event, data)
-            ctx.widget.api.removeEvents(self.event)
+        ctx.widget.api.fireEvent(event, data)
+        ctx.widget.api.removeEvents(event)
 
 
 class PyToJSInterface(object):
     """
     The actual object being registered on the JavaScript-side of the life;)
-    This tries to get exposed methods from the API object and yield it to JS.
+    This yields the exposed methods of the API object to JS.
     """
 
     def __init__(self, api):
 
         self.api = api
+        self._calls = dict(
+            (name, Proxy(getattr(api, name), exposed, api._js_ctx, api))
+            for name, exposed in get_dispatch_table(type(api)).iteritems()
+        )
 
 
     def __getattr__(self, obj_name):
 
-        obj = getattr(self.api, obj_name)
-        if isinstance(obj, Proxy):
-            return obj
-        raise AttributeError
+        try:
+            return self.__dict__['_calls'][obj_name]
+        except KeyError:
+            raise AttributeError(obj_name)
 
 
-class Thread(threading.Thread, gobject.GObject):
-    """ An advanced threading class emitting a GObject signal after running. """
+    def batch(self, calls, callback=None):
+        """
+        Call several exposed methods of the API at once, e.g. from JS::
 
-    __gtype_name__ = 'MelangeThread'
-    __gsignals__ = {
-        'finished': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,))
-        }
+            widget.api.weather.batch([['get_temperature', ['Berlin']], ['get_forecast', []]],
+                                     function(results) { ... });
 
-    def __init__(self, func, args=None, kwargs=None):
+        The calls are run one after another, in the given order, by a single
+        worker thread (the ones exposed with ``mode=MODE_MAIN`` are handed to
+        the main loop in between) and the callback gets the list of their
+        results. Cached results are used, but calls aren't joined with
+        identical ones of other widgets. APIs can't expose a method named
+        ``batch``.
 
-        self.func = func
-        self.args = args if args is not None else []
-        self.kwargs = kwargs if kwargs is not None else {}
+        :param calls: A list of ``[name, arguments]`` pairs.
 
-        threading.Thread.__init__(self)
-        gobject.GObject.__init__(self)
+        :raises AttributeError: If a method isn't exposed.
+        :raises PoolFull: If too many calls are waiting for a worker.
+        """
+
+        # Convert the JS objects here, they can't be used in other threads.
+        steps = []
+        for call in to_list(calls):
+            call = to_list(call)
+            proxy = self._calls.get(call[0])
+            if proxy is None:
+                raise AttributeError(call[0])
+            args = tuple(to_list(call[1])) if len(call) > 1 else ()
+            if proxy.exposed.mode == MODE_MAIN:
+                steps.append((proxy.method, args, True, MISSING))
+            else:
+                func, data = proxy.lookup(args)
+                steps.append((func, args, False, data))
+
+        event = 'batch:{0}'.format(CALL_IDS.next()) if callback else None
+
+        if any(func is not None and not in_main_loop for func, args, in_main_loop, data in steps):
+            done = None
+            if event:
+                done = lambda results: gobject.idle_add(self._finish_batch, event, results)
+            WORKER_POOL.submit(self.api, self._run_batch, (steps, True), done)
+        else:
+            # Nothing to do for a worker.
+            gobject.idle_add(self._run_batch_in_main_loop, event, steps)
+
+        if event:
+            self.api._js_ctx.widget.api.addEvent(event, callback)
+
+
+    @staticmethod
+    def _run_batch(steps, in_worker):
+
+        results = []
+        for func, args, in_main_loop, data in steps:
+            if func is not None:
+                if in_main_loop and in_worker:
+                    func = FunctionInMainThread(func)
+                try:
+                    data = func(*args)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+                    data = None
+            results.append(data)
+        return results
 
 
-    def run(self):
-        """ The function getting called on ``Thread.start()``. """
+    def _run_batch_in_main_loop(self, event, steps):
 
-        ret = self.func(*self.args, **self.kwargs)
-        gobject.timeout_add(0, self._emit, ret)
+        results = self._run_batch(steps, False)
+        if event:
+            self._finish_batch(event, results)
+        return False
 
 
-    def _emit(self, ret):
-        self.emit('finished', ret)
+    def _finish_batch(self, event, results):
+
+        api = self.api._js_ctx.widget.api
+        # Wrapped, so the callback gets the list as a single argument.
+        api.fireEvent(event, [results])
+        api.removeEvents(event)
+        return False
 
 
 class API(object):
     """ The API object to subclass when writing a Python API for JS widgets. """
 
+    _event_channel = None
+
     def emit(self, event, *args):
         """
         Emit an event with the given name and params.
@@ -149,21 +426,52 @@ class API(object):
         self._js_ctx.widget.api.fireEvent(event, *args)
 
 
-    def get_data_path(self):
-        return self._data_path
+    def publish(self, event, data=None):
+        """
+        Push an event with the given name and data to the widget's page.
+        Unlike `emit`, this may be called from any thread: the event is
+        queued and delivered through the page's event stream.
 
+        :param event: The event's name.
+        :param data: JSON-serializable data passed to the event's handlers.
+        """
 
-    def __getattribute__(self, obj_name):
+        if self._event_channel is not None:
+            self._event_channel.publish(event, data)
+        else:
+            # No event stream available, so hand the event to the main loop.
+            gobject.idle_add(self._fire_event, event, json.loads(json.dumps(data)))
 
-        obj = object.__getattribute__(self, obj_name)
 
-        try:
-            if getattr(obj, '_callable', None) == True:
-                return Proxy(obj, self._js_ctx)
-        except Exception, e:
-            import traceback
-            traceback.print_exc()
-        return obj
+    def _fire_event(self, event, data):
+        self._js_ctx.widget.api.fireEvent(event, [data])
+        return False
+
+
+    def invalidate_cache(self, name=None, *args):
+        """
+        Drop cached results of exposed methods (of all widget instances for
+        methods exposed with ``shared_cache=True``).
+
+        :param name: The method whose results to drop (all methods' if `None`).
+        :param args: The arguments of the call whose result to drop. If none
+                     are given, all results of the method are dropped.
+        """
+
+        for exposed in get_dispatch_table(type(self)).itervalues():
+            cache = get_result_cache(self, exposed)
+            if cache is None or name not in (None, exposed.name):
+                continue
+            if args:
+                key = cache.make_key(args)
+                if key is not None:
+                    cache.invalidate(key)
+            else:
+                cache.invalidate()
+
+
+    def get_data_path(self):
+        return self._data_path
 
 
 class FunctionInMainThread(object):
@@ -208,6 +516,7 @@ def register(api):
 
     def decorator(api):
         path = os.path.abspath(inspect.getsourcefile(api))
+        get_dispatch_table(api)
         APIS[path][name] = api
         return api
 
@@ -219,8 +528,63 @@ def register(api):
         return decorator(api)
 
 
-def expose(func):
-    """ Expose the given function to JS. """
+def get_stats():
+    """
+    Get the statistics of the worker pool and of the caches of exposed
+    methods of registered APIs.
+
+    :rtype: `dict`
+    """
+
+    caches = {}
+    with _result_caches_lock:
+        for method_id, method_caches in RESULT_CACHES.items():
+            # The caches of all instances of the method, summed up.
+            totals = defaultdict(int)
+            for cache in list(method_caches):
+                for name, value in cache.get_stats().iteritems():
+                    totals[name] += value
+            if totals:
+                caches['{0}:{1}.{2}'.format(*method_id)] = dict(totals)
+
+    stats = WORKER_POOL.get_stats()
+    stats['caches'] = caches
+    stats['calls'] = INFLIGHT_CALLS.get_stats()
+    return stats
+
+
+def expose(func=None, mode=MODE_THREAD, ttl=None, maxsize=None, key=None,
+           shared_cache=False, coalesce=False):
+    """
+    Expose the given function to JS.
+
+    Exposed methods are run in a thread of their own. Pass ``mode=MODE_MAIN``
+    (as in ``@expose(mode=MODE_MAIN)``) to run quick methods in the main loop
+    instead.
+
+    Passing `ttl` (in seconds) or `maxsize` caches the method's results: calls
+    with the same arguments (or the same result of the function `key`) are
+    answered from a cache keeping up to `maxsize` results for up to `ttl`
+    seconds. See `API.invalidate_cache`. Every widget instance has a cache of
+    its own; pass ``shared_cache=True`` to share it between all instances of
+    the API, if the results don't depend on the instance (its configuration,
+    for instance).
+
+    With ``coalesce=True``, a call made while an identical one (same API
+    source file, method and arguments) is running isn't run again; it gets
+    the running call's result. This also joins calls of different widget
+    instances.
+    """
+
+    def decorator(func):
+        func._callable = True
+        func._mode = mode
+        func._coalesce = coalesce
+        if ttl is not None or maxsize is not None:
+            func._cache_options = {'ttl': ttl, 'maxsize': maxsize, 'key': key,
+                                   'shared': shared_cache}
+        return func
 
-    func._callable = True
-    return func
+    if func is None:
+        return decorator
+    return decorator(func)
@@ -0,0 +1,396 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import os
+import re
+import gzip
+import base64
+import hashlib
+import urlparse
+import threading
+from cStringIO import StringIO
+from email.utils import formatdate
+from collections import OrderedDict
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+# `url(...)` and `@import "..."` references in style sheets:
+CSS_URL_RE = re.compile(r'''url\(\s*(["']?)([^"')\s]+)\1\s*\)|@import\s+(["'])([^"']+)\3''')
+
+# (extension, mimetype, worth compressing)
+MIMETYPES = [
+    ('html', 'text/html', True),
+    ('css', 'text/css', True), ('js', 'text/javascript', True),
+    ('png', 'image/png', False), ('svg', 'application/svg', True),
+    ('jpg', 'image/jpeg', False), ('jpeg', 'image/jpeg', False), ('gif', 'image/gif', False),
+    ('ogg', 'audio/ogg ', False), ('ttf', 'application/octet-stream ', True)
+]
+
+def make_stupid_mimetype_guess(filename):
+    for extension, mimetype, compressible in MIMETYPES:
+        if filename.endswith(extension):
+            return mimetype
+
+
+def make_data_uri(path, data):
+    """ Build a data URI for the contents `data` of the file at `path`. """
+
+    mimetype = make_stupid_mimetype_guess(path) or 'application/octet-stream'
+    return 'data:{0};base64,{1}'.format(mimetype, base64.b64encode(data))
+
+
+def is_compressible(filename):
+    for extension, mimetype, compressible in MIMETYPES:
+        if filename.endswith(extension):
+            return compressible
+    return False
+
+
+def make_etag(mtime, size):
+    """ Build an entity tag for a file whose contents have not been hashed. """
+
+    return '"{0:x}-{1:x}"'.format(int(mtime), size)
+
+
+def make_file_headers(path, size, mtime, etag):
+    """ Build the response headers for serving the file at `path`. """
+
+    headers = [
+        ('Content-Length', str(size)),
+        ('ETag', etag),
+        ('Last-Modified', formatdate(mtime, usegmt=True))
+    ]
+    mimetype = make_stupid_mimetype_guess(path)
+    if mimetype is not None:
+        headers.append(('Content-Type', mimetype))
+    return headers
+
+
+def rebase_css_urls(css, base_url):
+    """ Make the relative references in the style sheet `css` absolute. """
+
+    def replace(match):
+        url = match.group(2)
+        if url is not None:
+            if url.startswith('data:'):
+                return match.group(0)
+            return 'url("{0}")'.format(urlparse.urljoin(base_url, url))
+        return '@import "{0}"'.format(urlparse.urljoin(base_url, match.group(4)))
+
+    return CSS_URL_RE.sub(replace, css)
+
+
+class Asset(object):
+    """ The contents of a file together with the headers to serve it with. """
+
+    def __init__(self, path, data, mtime):
+
+        self.path = path
+        self.data = data
+        self.mtime = mtime
+        self.size = len(data)
+        self.digest = hashlib.sha1(data).hexdigest()
+        self.etag = '"{0}"'.format(self.digest)
+        self.headers = make_file_headers(path, self.size, mtime, self.etag)
+
+        self.compressible = is_compressible(path)
+        if self.compressible:
+            self.headers.append(('Vary', 'Accept-Encoding'))
+        self._gzipped = None
+
+
+    def get_gzipped(self):
+        """
+        Get the gzip-encoded variant of this asset, compressing it on first use.
+
+        :return: The variant or `None` if compressing doesn't make it smaller.
+        :rtype: `GzippedAsset`
+        """
+
+        if not self.compressible:
+            return None
+        if self._gzipped is None:
+            self._gzipped = GzippedAsset(self)
+        return self._gzipped if self._gzipped.size < self.size else None
+
+
+    def is_current(self):
+        """ Check whether the file on disk still matches this asset. """
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_mtime == self.mtime and stat.st_size == self.size
+
+
+class GzippedAsset(object):
+    """ The gzip-encoded variant of an `Asset`. """
+
+    def __init__(self, asset):
+
+        buf = StringIO()
+        # A fixed mtime keeps the output (and thus the ETag) deterministic.
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as gzip_file:
+            gzip_file.write(asset.data)
+
+        self.path = asset.path
+        self.data = buf.getvalue()
+        self.mtime = asset.mtime
+        self.size = len(self.data)
+        self.digest = asset.digest
+        self.etag = '"{0}-gzip"'.format(asset.digest)
+        self.headers = make_file_headers(asset.path, self.size, asset.mtime, self.etag)
+        self.headers.extend([('Content-Encoding', 'gzip'), ('Vary', 'Accept-Encoding')])
+
+
+class AssetCache(object):
+    """
+    A thread-safe LRU cache of file contents, bounded by the total size of the
+    cached files. If pyinotify is available, entries are invalidated by
+    watches on the watched directories; otherwise every hit is validated
+    against the file's modification time.
+    """
+
+    def __init__(self, max_size, max_file_size):
+
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+        self._watched = set()
+        self._watch_manager = None
+        self._notifier = None
+
+
+    def get(self, path):
+        """
+        Get the asset for the file at `path`, reading it if necessary.
+
+        :param path: Path of the file.
+
+        :return: The asset or `None` if the file is too large to be cached.
+        :rtype: `Asset`
+        """
+
+        path = os.path.realpath(path)
+
+        with self._lock:
+            asset = self._entries.get(path)
+            if asset is not None:
+                self.hits += 1
+                del self._entries[path]
+                self._entries[path] = asset
+            else:
+                self.misses += 1
+            generation = self._generation
+
+        if asset is not None:
+            if self._notifier is not None or asset.is_current():
+                return asset
+            self.invalidate(path)
+            with self._lock:
+                generation = self._generation
+
+        stat = os.stat(path)
+        if stat.st_size > self.max_file_size:
+            return None
+
+        with open(path, 'rb') as file_:
+            asset = Asset(path, file_.read(), stat.st_mtime)
+
+        with self._lock:
+            # Don't cache what might have been changed while reading it.
+            if generation == self._generation and path not in self._entries:
+                self._entries[path] = asset
+                self.size += asset.size
+                while self.size > self.max_size:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= evicted.size
+                    self.evictions += 1
+
+        return asset
+
+
+    def invalidate(self, path):
+        """ Drop the file at `path` or, if it is a directory, all files below it. """
+
+        prefix = path.rstrip(os.sep) + os.sep
+
+        with self._lock:
+            self._generation += 1
+            for entry in [p for p in self._entries if p == path or p.startswith(prefix)]:
+                self.size -= self._entries.pop(entry).size
+                self.invalidations += 1
+
+
+    def clear(self):
+
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self.size = 0
+
+
+    def watch(self, directory):
+        """ Invalidate cached files whenever something below `directory` changes. """
+
+        if pyinotify is None or directory in self._watched:
+            return
+
+        with self._lock:
+            if directory in self._watched:
+                return
+            self._watched.add(directory)
+
+            if self._notifier is None:
+                self._watch_manager = pyinotify.WatchManager()
+                self._notifier = pyinotify.ThreadedNotifier(self._watch_manager,
+                                                            _InvalidationHandler(cache=self))
+                self._notifier.daemon = True
+                self._notifier.start()
+
+        mask = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB \
+             | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO \
+             | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF
+        self._watch_manager.add_watch(os.path.realpath(directory), mask, rec=True, auto_add=True)
+
+
+    def get_stats(self):
+        """
+        Get the cache counters.
+
+        :rtype: `dict`
+        """
+
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'inotify': self._notifier is not None
+            }
+
+
+def hash_file(path, block_size=64*1024):
+    """ Compute the content hash (as used for `Asset.digest`) of the file at `path`. """
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file_:
+        for block in iter(lambda: file_.read(block_size), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class ContentIndex(object):
+    """
+    A thread-safe index of files by their content hashes. Files with the same
+    contents share a single canonical path, the first one added.
+    """
+
+    def __init__(self):
+
+        self._paths = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+
+
+    def add(self, path, digest):
+        """ Record that the file at `path` has the content hash `digest`. """
+
+        path = os.path.realpath(path)
+
+        with self._lock:
+            old_digest = self._digests.get(path)
+            if old_digest == digest:
+                return
+            if old_digest is not None and self._paths.get(old_digest) == path:
+                del self._paths[old_digest]
+            self._digests[path] = digest
+            self._paths.setdefault(digest, path)
+
+
+    def scan(self, directory):
+        """ Hash all files below `directory`. """
+
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    self.add(path, hash_file(path))
+                except (IOError, OSError):
+                    pass
+
+
+    def get_path(self, digest):
+        """ Get the canonical path of the contents with the hash `digest` or `None`. """
+
+        return self._paths.get(digest)
+
+
+    def discard(self, path):
+        """ Forget the file at `path`. """
+
+        path = os.path.realpath(path)
+
+        with self._lock:
+            digest = self._digests.pop(path, None)
+            if digest is not None and self._paths.get(digest) == path:
+                del self._paths[digest]
+                # Let another file with the same contents take over.
+                for other, other_digest in self._digests.iteritems():
+                    if other_digest == digest:
+                        self._paths[digest] = other
+                        break
+
+
+    def get_stats(self):
+
+        with self._lock:
+            return {
+                'files': len(self._digests),
+                'unique': len(self._paths)
+            }
+
+
+if pyinotify is not None:
+    class _InvalidationHandler(pyinotify.ProcessEvent):
+
+        def my_init(self, cache):
+            self.cache = cache
+
+        def process_default(self, event):
+            self.cache.invalidate(event.pathname)
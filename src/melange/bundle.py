@@ -0,0 +1,371 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import os
+import re
+import time
+import threading
+import urlparse
+from collections import OrderedDict
+
+from melange.assets import Asset, rebase_css_urls
+
+SCRIPT_TAG_RE = re.compile(r'''<script\b[^>]*?\bsrc\s*=\s*["']([^"']+)["'][^>]*>\s*</script>[ \t]*\n?''', re.I)
+STYLESHEET_TAG_RE = re.compile(r'''<link\b(?=[^>]*\brel\s*=\s*["']stylesheet["'])[^>]*?\bhref\s*=\s*["']([^"']+)["'][^>]*>[ \t]*\n?''', re.I)
+INLINE_SCRIPT_RE = re.compile(r'<script\b[^>]*>(.*?)</script>', re.I | re.S)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+CSS_IMPORT_RE = re.compile(r'''@import\s+(?:url\(\s*)?(["']?)([^"')\s;]+)\1\s*\)?\s*([^;]*);''')
+
+# Libraries that are left out of a bundle if nothing uses what they define:
+OPTIONAL_LIBRARIES = ('mootools-more.js',)
+
+# Maximum number of bundles kept around (the least recently used ones are
+# dropped first):
+MAX_BUNDLES = 32
+
+
+# Characters after which a slash starts a regular expression, not a division:
+REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^\n')
+REGEX_KEYWORDS = ('return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+                  'throw', 'case', 'do', 'else')
+
+
+def _is_preserved(comment):
+
+    lowered = comment.lower()
+    return 'copyright' in lowered or 'license' in lowered
+
+
+def _starts_regex(out):
+
+    code = ''.join(out[-32:]).rstrip(' \t')
+    if not code or code[-1] in REGEX_PRECEDERS:
+        return True
+    word = re.search(r'[A-Za-z_$][\w$]*$', code)
+    return word is not None and word.group(0) in REGEX_KEYWORDS
+
+
+def minify_js(source):
+    """
+    Remove comments, indentation and empty lines from `source`. Line breaks
+    are kept, so automatic semicolon insertion isn't affected. String,
+    template and regular expression literals are left alone, as are
+    comments mentioning a copyright or license.
+    """
+
+    out = []
+    index, length = 0, len(source)
+    quote = None
+
+    def newline():
+        while out and out[-1] in ' \t':
+            out.pop()
+        if out and out[-1] != '\n':
+            out.append('\n')
+
+    while index < length:
+        char = source[index]
+
+        if quote is not None:
+            # Inside a string or template literal: copy verbatim.
+            if char == '\\':
+                out.append(source[index:index + 2])
+                index += 2
+                continue
+            out.append(char)
+            if char == quote or (char == '\n' and quote != '`'):
+                quote = None
+            index += 1
+            continue
+
+        if char in '\'"`':
+            quote = char
+            out.append(char)
+            index += 1
+        elif source.startswith('//', index):
+            end = source.find('\n', index)
+            end = length if end == -1 else end
+            if _is_preserved(source[index:end]):
+                out.append(source[index:end].rstrip())
+            index = end
+        elif source.startswith('/*', index):
+            end = source.find('*/', index + 2)
+            end = length if end == -1 else end + 2
+            comment = source[index:end]
+            if _is_preserved(comment):
+                out.append(comment)
+            elif '\n' in comment:
+                newline()
+            elif out and out[-1] not in ' \t\n':
+                out.append(' ')
+            index = end
+        elif char == '/' and _starts_regex(out):
+            # Copy the regular expression up to its closing slash.
+            end = index + 1
+            in_class = False
+            while end < length and source[end] != '\n':
+                if source[end] == '\\':
+                    end += 1
+                elif source[end] == '[':
+                    in_class = True
+                elif source[end] == ']':
+                    in_class = False
+                elif source[end] == '/' and not in_class:
+                    break
+                end += 1
+            out.append(source[index:end + 1])
+            index = end + 1
+        elif char == '\n' or char == '\r':
+            newline()
+            index += 1
+        elif char in ' \t' and (not out or out[-1] == '\n'):
+            # Indentation.
+            index += 1
+        else:
+            out.append(char)
+            index += 1
+
+    newline()
+    return ''.join(out).strip()
+
+
+def minify_css(source):
+    """ Remove comments and superfluous whitespace from the style sheet `source`. """
+
+    source = CSS_COMMENT_RE.sub('', source)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,])\s*', r'\1', source)
+    return source.replace(';}', '}').strip()
+
+
+def inline_css_imports(css, path, url, read, seen=None):
+    """
+    Replace ``@import`` rules referring to local files by the imported style
+    sheets and make all remaining references absolute.
+
+    :param css: The style sheet.
+    :param path: Path of the style sheet's file.
+    :param url: URL the style sheet is served at.
+    :param read: Function returning the contents of a file.
+    """
+
+    seen = seen if seen is not None else set([path])
+
+    def replace(match):
+        imported, media = match.group(2), match.group(3).strip()
+        if urlparse.urlparse(imported).scheme:
+            return match.group(0)
+        imported_path = os.path.normpath(os.path.join(os.path.dirname(path), imported))
+        if imported_path in seen:
+            return ''
+        seen.add(imported_path)
+        imported_url = urlparse.urljoin(url, imported)
+        css = inline_css_imports(read(imported_path), imported_path, imported_url, read, seen)
+        return '@media {0} {{\n{1}\n}}'.format(media, css) if media else css
+
+    css = CSS_IMPORT_RE.sub(replace, CSS_COMMENT_RE.sub('', css))
+    return rebase_css_urls(css, url)
+
+
+def get_defined_names(source):
+    """
+    Find the classes, mutators, element properties and events and the
+    methods a (MooTools) library defines, as they would appear in a script
+    using them.
+    """
+
+    names = set()
+    for match in re.finditer(r'([A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*)\s*=\s*new Class\(', source):
+        names.add(match.group(1))
+    for match in re.finditer(r'Class\.Mutators\.([A-Za-z_$][\w$]*)\s*=', source):
+        if match.group(1) != 'initialize':
+            names.add(match.group(1) + ':')
+    # Used by name, e.g. ``element.get('slide')`` or ``element.addEvent('mouseenter', ...)``.
+    for match in re.finditer(r'Element\.(?:Properties|Events)\.([A-Za-z_$][\w$]*)\s*=', source):
+        names.add("'{0}'".format(match.group(1)))
+        names.add('"{0}"'.format(match.group(1)))
+    for block in re.finditer(r'\.implement\(\{(.*?)\}\);', source, re.S):
+        for match in re.finditer(r'(?:^|,)\s*([A-Za-z_$][\w$]*)\s*:\s*function', block.group(1)):
+            names.add('.' + match.group(1) + '(')
+    return names
+
+
+def is_referenced(names, sources):
+
+    return any(name in source for name in names for source in sources)
+
+
+class BundleBuilder(object):
+    """ Builds and keeps bundles of the JavaScript and CSS files a page refers to. """
+
+    def __init__(self):
+
+        self._bundles = OrderedDict()
+        self._by_digest = {}
+        self._defined_names = {}
+        self._decisions = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, digest):
+        """ Get the bundle with the given digest or `None`. """
+
+        key = self._by_digest.get(digest)
+        return self._lookup(key) if key is not None else None
+
+
+    def _lookup(self, key):
+
+        with self._lock:
+            bundle = self._bundles.pop(key, None)
+            if bundle is not None:
+                # Move to the end, it is the most recently used one now.
+                self._bundles[key] = bundle
+            return bundle
+
+
+    def _store(self, key, bundle):
+
+        with self._lock:
+            self._bundles.pop(key, None)
+            self._bundles[key] = bundle
+            self._by_digest[bundle.digest] = key
+            while len(self._bundles) > MAX_BUNDLES:
+                evicted_key, evicted = self._bundles.popitem(last=False)
+                if self._by_digest.get(evicted.digest) == evicted_key:
+                    del self._by_digest[evicted.digest]
+
+
+    def build_js(self, members, sources):
+        """
+        Build a JavaScript bundle.
+
+        :param members: ``(path, url, asset)`` tuples of the files to bundle.
+        :param sources: Further scripts of the page, to find out which
+                        optional libraries are needed, or `None` if they
+                        are not known.
+
+        :rtype: `Asset`
+        """
+
+        digests = tuple(asset.digest for path, url, asset in members)
+        decision = (digests, None if sources is None else tuple(sources))
+        key = self._decisions.get(decision)
+        if key is None:
+            key = ('js',) + tuple(asset.digest for asset in self._select_js(members, sources))
+            with self._lock:
+                if len(self._decisions) >= MAX_BUNDLES * 4:
+                    self._decisions.clear()
+                self._decisions[decision] = key
+
+        bundle = self._lookup(key)
+        if bundle is None:
+            included = [asset for path, url, asset in members if asset.digest in key]
+            data = '\n;\n'.join(minify_js(asset.data) for asset in included)
+            bundle = Asset('bundle.js', data, time.time())
+            self._store(key, bundle)
+        return bundle
+
+
+    def _select_js(self, members, sources):
+
+        contents = [asset.data for path, url, asset in members]
+        included = []
+        for index, (path, url, asset) in enumerate(members):
+            if sources is not None and os.path.basename(path) in OPTIONAL_LIBRARIES:
+                names = self._defined_names.get(asset.digest)
+                if names is None:
+                    names = self._defined_names[asset.digest] = get_defined_names(asset.data)
+                if not is_referenced(names, contents[:index] + contents[index + 1:] + list(sources)):
+                    continue
+            included.append(asset)
+        return included
+
+
+    def build_css(self, members, read):
+        """
+        Build a CSS bundle.
+
+        :param members: ``(path, url, asset)`` tuples of the style sheets to bundle.
+        :param read: Function returning the contents of an imported file.
+
+        :rtype: `Asset`
+        """
+
+        key = ('css',) + tuple(asset.digest for path, url, asset in members)
+        bundle = self._lookup(key)
+        # Imported files aren't part of the key, so check them for changes.
+        if bundle is not None and all(read(path) == data for path, data in bundle.imports):
+            return bundle
+
+        imports = []
+        def read_import(path):
+            data = read(path)
+            imports.append((path, data))
+            return data
+
+        data = '\n'.join(minify_css(inline_css_imports(asset.data, path, url, read_import))
+                         for path, url, asset in members)
+        # Remaining (external) imports are only valid at the beginning.
+        data = ''.join(match.group(0) for match in CSS_IMPORT_RE.finditer(data)) \
+               + CSS_IMPORT_RE.sub('', data)
+        bundle = Asset('bundle.css', data, time.time())
+        bundle.imports = imports
+        self._store(key, bundle)
+        return bundle
+
+
+def collapse_tags(page, tag_re, resolve, make_tag):
+    """
+    Replace each run of adjacent tags in `page` matched by `tag_re` whose
+    URLs `resolve` accepts with a single tag. Only whitespace may separate
+    the tags of a run, so the order of the page's scripts and style sheets
+    is kept.
+
+    :param resolve: Function returning ``(path, url, asset)`` for a URL or `None`.
+    :param make_tag: Function returning the new tag for a list of such tuples.
+
+    :return: The new page.
+    """
+
+    runs = []
+    run = []
+    position = 0
+    for match in tag_re.finditer(page):
+        member = resolve(match.group(1))
+        if member is None or page[position:match.start()].strip():
+            if len(run) > 1:
+                runs.append(run)
+            run = []
+        if member is not None:
+            run.append((member, match.span()))
+        position = match.end()
+    if len(run) > 1:
+        runs.append(run)
+
+    if not runs:
+        return page
+
+    result = []
+    position = 0
+    for run in runs:
+        start = run[0][1][0]
+        result.extend((page[position:start], make_tag([member for member, span in run])))
+        position = run[-1][1][1]
+    result.append(page[position:])
+    return ''.join(result)
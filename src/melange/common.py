@@ -21,6 +21,54 @@ HTTPSERVER_PORT = 8081
 HTTPSERVER_BASE_URL = 'http://{host}:{port}'.format(host=HTTPSERVER_HOST,
                                                     port=HTTPSERVER_PORT)
 
+# Seconds a request waits for its widget instance to be registered:
+HTTPSERVER_INSTANCE_TIMEOUT = 2
+
+# Limits of the in-memory cache for /common, /theme and /widget files:
+ASSET_CACHE_SIZE = 16 * 1024 * 1024
+ASSET_CACHE_MAX_FILE_SIZE = 1024 * 1024
+
+# Block size for streaming files that aren't cached:
+HTTPSERVER_FILE_BLOCK_SIZE = 64 * 1024
+
+# Lifetime of responses for URLs carrying the content's hash:
+HTTPSERVER_VERSIONED_MAX_AGE = 365 * 24 * 60 * 60
+
+# In the in-process mode, resources up to this size (and not below /data) are
+# passed to the widgets directly; anything else is loaded over HTTP:
+INPROCESS_MAX_SIZE = 256 * 1024
+
+# Images up to this size are embedded into pages and style sheets:
+INLINE_IMAGE_MAX_SIZE = 4 * 1024
+
+# Scaling of images below /data:
+IMAGE_SCALER_WORKERS = 2
+IMAGE_SCALE_TIMEOUT = 10
+IMAGE_CACHE_SIZE = 64 * 1024 * 1024
+IMAGE_MAX_DIMENSION = 4096
+
+# Caching proxy for external resources:
+PROXY_CACHE_SIZE = 64 * 1024 * 1024
+PROXY_MAX_ENTRY_SIZE = 16 * 1024 * 1024
+PROXY_TIMEOUT = 15
+PROXY_MAX_IDLE_CONNECTIONS = 4
+PROXY_MAX_REDIRECTS = 5
+
+# Number of events queued per widget instance for its page:
+EVENTS_QUEUE_SIZE = 256
+
+# Seconds between comments sent on idle event streams:
+EVENTS_HEARTBEAT_INTERVAL = 15
+
+# Worker threads running exposed API methods, the number of calls that may
+# wait for them and how many calls of a single widget may run at once:
+API_WORKERS = 8
+API_QUEUE_SIZE = 256
+API_CONCURRENCY_PER_WIDGET = 2
+
+# Number of results kept per exposed method caching its results:
+API_RESULT_CACHE_SIZE = 128
+
 # Timestep for moving actions:
 MOVE_TIMESTEP = 30
 
@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import json
+import threading
+from collections import deque
+
+from melange.common import EVENTS_QUEUE_SIZE, EVENTS_HEARTBEAT_INTERVAL
+
+
+class EventChannel(object):
+    """
+    A thread-safe queue of events pushed to a widget instance's page as a
+    stream of server-sent events. Events published while the page isn't
+    listening are kept (up to `EVENTS_QUEUE_SIZE`) and delivered once it
+    connects.
+    """
+
+    def __init__(self, size=EVENTS_QUEUE_SIZE):
+
+        self._events = deque(maxlen=size)
+        self._next_id = 1
+        self._delivered = 0
+        self._condition = threading.Condition()
+        self.closed = False
+
+        self.published = 0
+        self.dropped = 0
+        self.subscribers = 0
+
+
+    def publish(self, event, data=None):
+        """
+        Queue an event for the page. May be called from any thread.
+
+        :param event: The event's name.
+        :param data: JSON-serializable data to pass to the event's handlers.
+        """
+
+        payload = json.dumps({'event': event, 'data': data})
+
+        with self._condition:
+            if len(self._events) == self._events.maxlen and self._events[0][0] > self._delivered:
+                self.dropped += 1
+            self._events.append((self._next_id, payload))
+            self._next_id += 1
+            self.published += 1
+            self._condition.notify_all()
+
+
+    def close(self):
+        """ End all streams of this channel. """
+
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+    def stream(self, heartbeat=EVENTS_HEARTBEAT_INTERVAL):
+        """
+        Generate the ``text/event-stream`` response body, starting with the
+        oldest event not yet delivered. Comments are sent while there are no
+        events, so closed connections are noticed.
+        """
+
+        with self._condition:
+            self.subscribers += 1
+            position = self._delivered + 1
+
+        try:
+            yield 'retry: 2000\n\n'
+            while True:
+                with self._condition:
+                    pending = [e for e in self._events if e[0] >= position]
+                    if not pending and not self.closed:
+                        self._condition.wait(heartbeat)
+                        pending = [e for e in self._events if e[0] >= position]
+                    if self.closed:
+                        return
+                    if pending:
+                        position = pending[-1][0] + 1
+                        self._delivered = max(self._delivered, position - 1)
+
+                if pending:
+                    yield ''.join('id: {0}\ndata: {1}\n\n'.format(id, payload)
+                                  for id, payload in pending)
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            with self._condition:
+                self.subscribers -= 1
+
+
+    def get_stats(self):
+
+        with self._condition:
+            return {
+                'queued': len(self._events),
+                'published': self.published,
+                'dropped': self.dropped,
+                'subscribers': self.subscribers
+            }
+
+
+class EventChannels(object):
+    """ The event channels of all widget instances. """
+
+    def __init__(self):
+
+        self._channels = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, instance_id):
+        """ Get the channel of the given instance, creating it if necessary. """
+
+        with self._lock:
+            channel = self._channels.get(instance_id)
+            if channel is None:
+                channel = self._channels[instance_id] = EventChannel()
+            return channel
+
+
+    def close(self, instance_id):
+        """ Close and forget the channel of the given instance. """
+
+        with self._lock:
+            channel = self._channels.pop(instance_id, None)
+        if channel is not None:
+            channel.close()
+
+
+    def get_stats(self):
+
+        with self._lock:
+            channels = self._channels.items()
+        return dict((instance_id, channel.get_stats()) for instance_id, channel in channels)
@@ -19,15 +19,55 @@
 import os
 import re
 import sys
-import urlparse
-from bjoern import run
 import time
+import urllib
+import httplib
+import json
+import urlparse
+import itertools
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+from melange.wsgiserver import BACKENDS, start_threaded
+from melange.stats import RequestStats, RecordingBody
+from melange.events import EventChannels
+from melange.images import ImageScaler, IMAGE_EXTENSIONS
+from melange.proxy import ProxyCache, ProxyError, TooLarge
+from melange.skins import SkinCompiler
+from melange.themes import ThemeImageInliner
+from melange.bundle import BundleBuilder, collapse_tags, SCRIPT_TAG_RE, STYLESHEET_TAG_RE, \
+                           INLINE_SCRIPT_RE
+from melange.assets import Asset, AssetCache, make_etag, make_file_headers, \
+                           make_stupid_mimetype_guess, make_data_uri
+from melange.common import HTTPSERVER_BASE_URL, HTTPSERVER_INSTANCE_TIMEOUT, \
+                           HTTPSERVER_VERSIONED_MAX_AGE, HTTPSERVER_FILE_BLOCK_SIZE, \
+                           ASSET_CACHE_SIZE, ASSET_CACHE_MAX_FILE_SIZE, IMAGE_MAX_DIMENSION, \
+                           INLINE_IMAGE_MAX_SIZE
+
+# Files resolving references relative to their own URL, which therefore have
+# to be served below their theme:
+SELF_RELATIVE_EXTENSIONS = ('.css', '.html')
+
+# Theme images embedded into pages when small enough:
+INLINE_IMAGE_MIMETYPES = ('image/png', 'image/gif', 'image/jpeg')
+
+# `src` and `href` attributes pointing to files below /common or /theme:
+VERSIONABLE_URL_RE = re.compile(
+    r'''(\b(?:src|href)\s*=\s*["'](?:{0})?)/(common|theme)/([^"'?#]+)(?=["'])'''.format(
+        re.escape(HTTPSERVER_BASE_URL))
+)
 
-def route(url_regex):
+# Routes are tried in the order they are declared in:
+_route_order = itertools.count()
+
+def route(url_regex, methods=None):
     def decorator(func):
         if not hasattr(func, '__bjoern_routes__'):
             func.__bjoern_routes__ = []
+            func.__bjoern_route_order__ = next(_route_order)
         func.__bjoern_routes__.append(re.compile(url_regex))
+        if methods is not None:
+            func.__bjoern_methods__ = tuple(methods)
         return func
     return decorator
 
@@ -35,19 +75,337 @@ def query_string_to_dict(query_string):
     return dict((header_name, header_values[0]) for header_name, header_values in
                 urlparse.parse_qs(query_string).iteritems())
 
-def make_stupid_mimetype_guess(filename):
-    for extension, mimetype in [
-        ('html', 'text/html'),
-        ('css', 'text/css'), ('js', 'text/javascript'),
-        ('png', 'image/png'), ('svg', 'application/svg'),
-        ('ogg', 'audio/ogg '), ('ttf', 'application/octet-stream ')
-    ]:
-        if filename.endswith(extension):
-            return mimetype
+def get_query_value(query_string, key):
+    """ Extract the first value of `key` from `query_string` without parsing all of it. """
+
+    prefix = key + '='
+    if query_string.startswith(prefix):
+        start = len(prefix)
+    else:
+        start = query_string.find('&' + prefix)
+        if start == -1:
+            return None
+        start += len(prefix) + 1
+
+    end = query_string.find('&', start)
+    value = query_string[start:] if end == -1 else query_string[start:end]
+    if '%' in value or '+' in value:
+        value = urllib.unquote_plus(value)
+    return value or None
+
+
+class QueryString(object):
+    """
+    The GET parameters of a request. ``instance``, which nearly every request
+    carries, is extracted directly; the query string is only parsed completely
+    if any other parameter is asked for.
+    """
+
+    def __init__(self, query_string):
+
+        self.query_string = query_string
+        self._params = None
+
+
+    def get(self, key, default=None):
+
+        if key == 'instance':
+            value = get_query_value(self.query_string, key)
+        else:
+            if self._params is None:
+                self._params = query_string_to_dict(self.query_string)
+            value = self._params.get(key)
+        return value if value is not None else default
+
+
+    def __getitem__(self, key):
+
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+# Python's `re` refuses patterns with more than 100 groups, so large
+# route tables are split up into several combined patterns.
+MAX_GROUPS_PER_PATTERN = 90
+
+_GROUP_NAME_RE = re.compile(r'\(\?P([<=])(\w+)')
+
+def compile_routes(routed_methods):
+    """
+    Compile the routes of the given methods into as few regular expressions as
+    possible. Every route becomes a named alternative whose own named groups
+    are prefixed with the alternative's name, so one match tells both which
+    method to call and what its keyword arguments are.
+
+    :return: A list of compiled patterns and a `dict` mapping alternative
+             names to ``(method, group prefix, group names)``.
+    """
+
+    patterns = []
+    targets = {}
+    alternatives = []
+    groups = 0
+
+    for func in routed_methods:
+        for route in func.__bjoern_routes__:
+            name = '_route%d' % len(targets)
+            prefix = name + '_'
+            pattern = _GROUP_NAME_RE.sub(
+                lambda match: '(?P{0}{1}{2}'.format(match.group(1), prefix, match.group(2)),
+                route.pattern
+            )
+
+            if alternatives and groups + route.groups + 1 > MAX_GROUPS_PER_PATTERN:
+                patterns.append(re.compile('|'.join(alternatives)))
+                alternatives = []
+                groups = 0
+
+            alternatives.append('(?P<{0}>{1})'.format(name, pattern))
+            groups += route.groups + 1
+            targets[name] = (func, prefix, route.groupindex.keys())
+
+    if alternatives:
+        patterns.append(re.compile('|'.join(alternatives)))
+
+    return patterns, targets
+
+
+def not_modified_headers(headers):
+    return [(name, value) for name, value in headers if name != 'Content-Length']
+
+def is_not_modified(environ, etag, mtime):
+    """ Check the request's conditional headers against the given validators. """
+
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None:
+        since = parsedate_tz(if_modified_since.split(';')[0])
+        if since is not None:
+            return int(mtime) <= mktime_tz(since)
+
+    return False
+
+
+def accepts_gzip(environ):
+    """ Check whether the client accepts gzip-encoded responses. """
+
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def parse_range(header, size):
+    """
+    Parse a ``Range`` header asking for a single byte range.
+
+    :param header: The header's value.
+    :param size: Size of the requested file.
+
+    :return: First and last byte of the range, `None` if the header is
+             malformed or asks for multiple ranges, which means the whole
+             file is to be sent.
+    :raises ValueError: If the range can't be satisfied.
+    """
+
+    unit, _, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+
+    first, _, last = ranges.strip().partition('-')
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+
+    if first is None:
+        # The last n bytes:
+        if last is None:
+            return None
+        if not last:
+            raise ValueError("empty suffix range")
+        return max(size - last, 0), size - 1
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        raise ValueError("range starts after the end of the file")
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+class FileBlocks(object):
+    """
+    Iterate over (a range of) a file in blocks of a fixed size. Used for
+    ranges and if the WSGI server doesn't provide ``wsgi.file_wrapper``.
+    """
+
+    def __init__(self, file_, block_size, start=0, length=None):
+
+        self.file = file_
+        self.block_size = block_size
+        self.start = start
+        self.length = length
+
+
+    def __iter__(self):
+
+        read = self.file.read
+        block_size = self.block_size
+        remaining = self.length
+
+        if self.start:
+            self.file.seek(self.start)
+
+        while remaining is None or remaining > 0:
+            block = read(block_size if remaining is None else min(block_size, remaining))
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            yield block
+
+
+    def close(self):
+        self.file.close()
+
+
+def wrap_file(environ, file_):
+    """ Let the WSGI server send `file_` as efficiently as it can (e.g. using sendfile). """
+
+    file_wrapper = environ.get('wsgi.file_wrapper', FileBlocks)
+    return file_wrapper(file_, HTTPSERVER_FILE_BLOCK_SIZE)
+
+
+class Response(object):
+    """ A response with an explicit status and headers. """
+
+    def __init__(self, body, status='200 Alles in Butter', headers=None):
+
+        self.body = body
+        self.status = status
+        self.headers = headers if headers is not None else []
+
+
+class InstanceReadiness(object):
+    """
+    Keeps track of the widget instances known to the `WidgetManager`.
+    Requests for an instance that is not registered yet can wait for it
+    instead of racing against the widget setup.
+    """
+
+    def __init__(self):
+
+        self._events = {}
+        self._lock = threading.Lock()
+
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+
+    def _get_event(self, instance_id):
+
+        with self._lock:
+            event = self._events.get(instance_id)
+            if event is None:
+                event = self._events[instance_id] = threading.Event()
+            return event
+
+
+    def set_ready(self, instance_id):
+        """ Mark the given instance as registered and wake up waiting requests. """
+
+        self._get_event(instance_id).set()
+
+
+    def forget(self, instance_id):
+        """ Forget about the given (removed) instance. """
+
+        with self._lock:
+            self._events.pop(instance_id, None)
+
+
+    def wait(self, instance_id, timeout):
+        """
+        Wait until the given instance is ready.
+
+        :param instance_id: The instance to wait for.
+        :param timeout: Maximum time to wait in seconds.
+
+        :return: Whether the instance is ready.
+        :rtype: `bool`
+        """
+
+        event = self._get_event(instance_id)
+        if event.is_set():
+            return True
+
+        start = time.time()
+        ready = event.wait(timeout)
+        waited = time.time() - start
+
+        with self._lock:
+            self.waits += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            if not ready:
+                self.timeouts += 1
+                # Don't keep events for instances that never showed up.
+                if self._events.get(instance_id) is event:
+                    del self._events[instance_id]
+
+        return ready
+
+
+    def get_stats(self):
+        """
+        Get the counters of requests that had to wait for their instance.
+
+        :return: Number of waits and timeouts, total and maximum wait time.
+        :rtype: `dict`
+        """
+
+        with self._lock:
+            return {
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time
+            }
+
 
 class SmallWebFramework(object):
+    # Requests for paths starting with these are served with a lower priority.
+    bulk_prefixes = ()
+    # Requests for paths starting with these are long-lived streams.
+    stream_prefixes = ()
+
     def __init__(self):
         self.routed_methods = self._get_routed()
+        self._route_patterns, self._route_targets = compile_routes(self.routed_methods)
+        self.stats = RequestStats()
+        self.backend = None
+        self.base_url = None
 
     def _get_routed(self):
         routed = []
@@ -55,73 +413,512 @@ class SmallWebFramework(object):
             func = getattr(self, attr)
             if hasattr(func, '__bjoern_routes__'):
                 routed.append(func)
+        routed.sort(key=lambda func: func.__bjoern_route_order__)
         return routed
 
-    def run(self, host, port):
-        run(self, host, port)
+    def _get_stats_instance(self, GET):
+        """ Get the widget instance a request is accounted to, or `None`. """
+        return GET.get('instance')
+
+    def run(self, host, port, backend='threaded'):
+        self.backend = backend
+        self.base_url = 'http://{0}:{1}'.format(host, port)
+        BACKENDS[backend](self, host, port, self.bulk_prefixes, self.stream_prefixes)
+
+    def start(self, host, port=0):
+        """
+        Serve from a thread of its own using the threaded backend. Unlike
+        `run`, this returns as soon as the server listens, on a free port
+        if `port` is 0.
+        """
+        self.backend = 'threaded'
+        self.base_url = 'http://{0}:{1}'.format(
+            *start_threaded(self, host, port, self.bulk_prefixes, self.stream_prefixes))
 
     def __call__(self, environ, start_response):
         """ The WSGI application called by bjoern """
 
-        time.sleep(.02) # ARGH. HACK.
-
-        GET = query_string_to_dict(environ.get('QUERY_STRING', ''))
+        start = time.time()
+        GET = QueryString(environ.get('QUERY_STRING', ''))
         func, kwargs = self.dispatch(environ)
+
+        sent = {}
+        def recording_start_response(status, headers, exc_info=None):
+            sent['status'] = status
+            sent['headers'] = headers
+            return start_response(status, headers, exc_info)
+
+        body = self.respond(environ, recording_start_response, GET, func, kwargs)
+        dispatch_time = time.time() - start
+
+        route = func.__name__ if func is not None else '-'
+        instance = self._get_stats_instance(GET)
+        status = int(sent['status'].split(' ', 1)[0])
+
+        def record(bytes_sent, streaming_time=None):
+            self.stats.record(route, instance, status, bytes_sent, dispatch_time, streaming_time)
+
+        if isinstance(body, list):
+            record(sum(len(data) for data in body))
+            return body
+        if type(body) is environ.get('wsgi.file_wrapper'):
+            # Wrapping this would keep the server from using sendfile.
+            record(int(dict(sent['headers']).get('Content-Length', 0)))
+            return body
+        return RecordingBody(body, record)
+
+    def respond(self, environ, start_response, GET, func, kwargs):
+        """ Call the routed method `func` and turn its return value into a response. """
+
         if func is None:
-            start_response('404 Not Found', [('Content-Length', '13')])
-            return 'Not Found'
+            start_response('404 Not Found', [('Content-Length', '9')])
+            return ['Not Found']
+        methods = getattr(func, '__bjoern_methods__', None)
+        if methods is not None and environ.get('REQUEST_METHOD', 'GET') not in methods:
+            start_response('405 Method Not Allowed',
+                           [('Allow', ', '.join(methods)), ('Content-Length', '18')])
+            return ['Method Not Allowed']
         try:
             response = func(GET, **kwargs)
         except:
             start_response('500 Python Error :(', [('Content-Length', '21')], sys.exc_info())
-            return 'Internal Server Error'
+            return ['Internal Server Error']
         else:
+            if isinstance(response, Response):
+                headers = response.headers
+                if isinstance(response.body, str):
+                    headers = headers + [('Content-Length', str(len(response.body)))]
+                    start_response(response.status, headers)
+                    return [response.body]
+                start_response(response.status, headers)
+                return response.body
+            if isinstance(response, Asset):
+                if GET.get('v') == response.digest:
+                    # The URL changes with the content, so it may be cached forever.
+                    cache_control = 'public, max-age={0}'.format(HTTPSERVER_VERSIONED_MAX_AGE)
+                else:
+                    cache_control = 'no-cache'
+                if response.compressible and accepts_gzip(environ):
+                    response = response.get_gzipped() or response
+                headers = response.headers + [('Cache-Control', cache_control)]
+                if is_not_modified(environ, response.etag, response.mtime):
+                    start_response('304 Not Modified', not_modified_headers(headers))
+                    return []
+                start_response('200 Alles in Butter', headers)
+                return [response.data]
             if isinstance(response, file):
-                mimetype = make_stupid_mimetype_guess(response.name)
-                headers = [('Content-Length', str(os.path.getsize(response.name)))]
-                if mimetype is not None:
-                    headers.append(('Content-Type', mimetype))
-            else:
-                headers = []
-            start_response('200 Alles in Butter', headers)
+                stat = os.fstat(response.fileno())
+                etag = make_etag(stat.st_mtime, stat.st_size)
+                headers = make_file_headers(response.name, stat.st_size, stat.st_mtime, etag)
+                headers.extend([('Cache-Control', 'no-cache'), ('Accept-Ranges', 'bytes')])
+                if is_not_modified(environ, etag, stat.st_mtime):
+                    response.close()
+                    start_response('304 Not Modified', not_modified_headers(headers))
+                    return []
+                if 'HTTP_RANGE' in environ and environ.get('HTTP_IF_RANGE', etag) == etag:
+                    return self._serve_range(environ, start_response, response, stat.st_size, headers)
+                start_response('200 Alles in Butter', headers)
+                return wrap_file(environ, response)
+            start_response('200 Alles in Butter', [])
             return response
 
+    def get_stats(self):
+        """
+        Get the server's statistics.
+
+        :rtype: `dict`
+        """
+
+        return {'requests': self.stats.get_stats()}
+
+    @route(r'/_stats$')
+    def stats_page(self, GET):
+        return Response(json.dumps(self.get_stats(), sort_keys=True),
+                        headers=[('Content-Type', 'application/json'), ('Cache-Control', 'no-cache')])
+
+    def fetch(self, path, query_string='', max_size=None):
+        """
+        Serve a request in-process, without going through a WSGI server.
+        Streams aren't served, they would never end.
+
+        :param path: The requested path.
+        :param query_string: The request's query string.
+        :param max_size: If given, bodies of responses known to be larger
+                         aren't read.
+
+        :return: Status code, headers and body (`None` if it is too large)
+                 of the response.
+        :rtype: `tuple`
+        """
+
+        if path.startswith(self.stream_prefixes):
+            return 501, {'Content-Length': '15'}, 'Not Implemented'
+
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': query_string
+        }
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = dict(headers)
+
+        body = self(environ, start_response)
+        try:
+            if max_size is not None and \
+                    int(response['headers'].get('Content-Length', 0)) > max_size:
+                return response['status'], response['headers'], None
+            data = ''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return response['status'], response['headers'], data
+
+    def _serve_range(self, environ, start_response, file_, size, headers):
+
+        try:
+            byte_range = parse_range(environ['HTTP_RANGE'], size)
+        except ValueError:
+            file_.close()
+            start_response('416 Requested Range Not Satisfiable', [
+                ('Content-Length', '0'),
+                ('Content-Range', 'bytes */{0}'.format(size))
+            ])
+            return []
+
+        if byte_range is None:
+            start_response('200 Alles in Butter', headers)
+            return wrap_file(environ, file_)
+
+        first, last = byte_range
+        length = last - first + 1
+        headers = [(name, value) for name, value in headers if name != 'Content-Length']
+        headers.extend([
+            ('Content-Length', str(length)),
+            ('Content-Range', 'bytes {0}-{1}/{2}'.format(first, last, size))
+        ])
+        start_response('206 Partial Content', headers)
+        return FileBlocks(file_, HTTPSERVER_FILE_BLOCK_SIZE, first, length)
+
     def dispatch(self, environ):
         path = environ.get('PATH_INFO', '')
-        for func in self.routed_methods:
-            for route in func.__bjoern_routes__:
-                match = route.match(path)
-                if match is not None:
-                    return func, match.groupdict()
+        for pattern in self._route_patterns:
+            match = pattern.match(path)
+            if match is not None:
+                func, prefix, names = self._route_targets[match.lastgroup]
+                return func, dict((name, match.group(prefix + name)) for name in names)
         return None, None
 
 
 class HttpServer(SmallWebFramework):
+    bulk_prefixes = ('/data/',)
+    stream_prefixes = ('/events',)
+
     def __init__(self, melange):
         SmallWebFramework.__init__(self)
         self._melange = melange
+        self.readiness = InstanceReadiness()
+        self.assets = AssetCache(ASSET_CACHE_SIZE, ASSET_CACHE_MAX_FILE_SIZE)
+        self._common_path = os.path.join(melange.context.get_path(), 'data/common')
+        self.bundles = BundleBuilder()
+        self.skins = SkinCompiler(self._read)
+        self.theme_images = ThemeImageInliner()
+        self.events = EventChannels()
+        self.images = ImageScaler(os.path.join(melange.context.get_user_path(), 'cache/images'))
+        self.proxy = ProxyCache(os.path.join(melange.context.get_user_path(), 'cache/proxy'))
+        self._themes = {}
+
+    def _get_stats_instance(self, GET):
+        # Only registered instances get statistics of their own.
+        instance_id = GET.get('instance')
+        try:
+            return instance_id if self._melange.widgets.has_key(instance_id) else None
+        except AttributeError:
+            return None
+
+    def _get_widget(self, instance_id):
+        try:
+            return self._melange.widgets[instance_id]
+        except (AttributeError, KeyError):
+            # The widget's view may request files before the widget is added
+            # to the WidgetManager, so give it a chance to show up.
+            self.readiness.wait(instance_id, HTTPSERVER_INSTANCE_TIMEOUT)
+            return self._melange.widgets[instance_id]
+
+    def _get_theme(self, theme_id):
+        theme = self._themes.get(theme_id)
+        if theme is None:
+            theme = self._themes[theme_id] = self._melange.themes.get(id=theme_id).next()
+        return theme
 
     def _get_widget_theme(self, GET):
+        theme_id = GET.get('theme')
+        if theme_id:
+            return self._get_theme(theme_id)
         widget_id = GET.get('instance')
         if widget_id:
-            return self._melange.widgets[widget_id].get_current_theme()
+            return self._get_widget(widget_id).get_current_theme()
         else:
-            return self._melange.themes.get_by_id(self._melange.config.default_theme)
+            return self._get_theme(self._melange.config.default_theme)
+
+    def _get_common_path(self):
+        return self._common_path
+
+    def _get_asset(self, root, file):
+        self.assets.watch(root)
+        return self.assets.get(os.path.join(root, file))
+
+    def _get_theme_asset(self, root, file):
+        """ Like `_get_asset`, with the theme's small images embedded into style sheets and scripts. """
+
+        asset = self._get_asset(root, file)
+        if asset is not None and file.endswith(('.css', '.js')):
+            asset = self.theme_images.process(asset, file, lambda other: self._get_asset(root, other),
+                                              self._share_theme_asset)
+        return asset
+
+    def _share_theme_asset(self, asset):
+        """
+        Get the URL of the theme file `asset` that is the same for all themes
+        containing the file and all widgets using them.
+
+        :return: The URL or `None` for files that refer to files next to them.
+        """
+
+        if asset.path.endswith(SELF_RELATIVE_EXTENSIONS):
+            return None
+        self._melange.theme_contents.add(asset.path, asset.digest)
+        return '/theme/_content/{0}?{1}'.format(
+            urllib.quote(os.path.basename(asset.path)), urllib.urlencode({'v': asset.digest}))
+
+    def _serve_cached(self, root, file):
+        return self._get_asset(root, file) or open(os.path.join(root, file), 'rb')
+
+    def _read(self, path):
+        asset = self.assets.get(path)
+        if asset is not None:
+            return asset.data
+        with open(path, 'rb') as file_:
+            return file_.read()
+
+    def _prepare_page(self, page, GET):
+        data = page.data
+        if self._melange.config.compile_skins:
+            skin_path = self._get_widget(GET['instance']).get_skin_path()
+            data = self.skins.compile(skin_path, page.path, data, '/widget/')
+        if self._melange.config.bundle_assets:
+            data = self._bundle_urls(data, GET)
+        return Asset(page.path, self._version_urls(data, GET), page.mtime)
+
+    def _bundle_urls(self, page, GET):
+        """
+        Replace adjacent references to scripts and style sheets below
+        /common and /theme by JavaScript and CSS bundles.
+        """
+
+        theme = self._get_widget_theme(GET)
+        skin_path = self._get_widget(GET['instance']).get_skin_path()
+
+        def resolve(url):
+            if url.startswith(HTTPSERVER_BASE_URL):
+                url = url[len(HTTPSERVER_BASE_URL):]
+            url = url.split('?', 1)[0].split('#', 1)[0]
+            for prefix, root in (('/common/', self._common_path), ('/theme/', theme['path'])):
+                if url.startswith(prefix):
+                    get_asset = self._get_theme_asset if prefix == '/theme/' else self._get_asset
+                    try:
+                        asset = get_asset(root, url[len(prefix):])
+                    except (IOError, OSError):
+                        return None
+                    if asset is not None:
+                        return asset.path, url, asset
+            return None
+
+        # The page's other scripts decide which optional libraries are needed.
+        # Finding their uses is guesswork, so libraries are only left out on
+        # request.
+        sources = None
+        scripts = []
+        if self._melange.config.trim_libraries:
+            sources = [match.group(1) for match in INLINE_SCRIPT_RE.finditer(page)]
+            for match in SCRIPT_TAG_RE.finditer(page):
+                url = match.group(1)
+                member = resolve(url)
+                if member is not None:
+                    scripts.append(member)
+                    continue
+                if urlparse.urlparse(url).scheme or url.startswith('/'):
+                    sources = None
+                    break
+                try:
+                    sources.append(self._read(os.path.join(skin_path, url.split('?', 1)[0])))
+                except (IOError, OSError):
+                    sources = None
+                    break
+
+        def make_script_tag(members):
+            # Scripts bundled separately still count as the page's other scripts.
+            others = sources
+            if others is not None:
+                urls = set(url for path, url, asset in members)
+                others = others + [asset.data for path, url, asset in scripts if url not in urls]
+            bundle = self.bundles.build_js(members, others)
+            return '<script type="text/javascript" src="/theme/_bundle.js?v={0}"></script>\n'.format(
+                bundle.digest)
+
+        def make_stylesheet_tag(members):
+            bundle = self.bundles.build_css(members, self._read)
+            return '<link rel="stylesheet" type="text/css" href="/theme/_bundle.css?v={0}" />\n'.format(
+                bundle.digest)
+
+        page = collapse_tags(page, SCRIPT_TAG_RE, resolve, make_script_tag)
+        return collapse_tags(page, STYLESHEET_TAG_RE, resolve, make_stylesheet_tag)
+
+    def _version_urls(self, page, GET):
+        """
+        Make the page refer to files below /common and /theme by URLs
+        containing the files' content hashes. Such URLs don't depend on the
+        widget instance, so all widgets share the cached files.
+        """
+
+        theme = self._get_widget_theme(GET)
+
+        def replace(match):
+            prefix, kind, file = match.groups()
+            if kind == 'common':
+                root, params = self._get_common_path(), []
+            else:
+                root, params = theme['path'], [('theme', theme['id'])]
+            try:
+                asset = self._get_asset(root, file)
+                processed = self._get_theme_asset(root, file) if kind == 'theme' else asset
+            except (IOError, OSError):
+                asset = None
+            if asset is None:
+                return match.group(0)
+            if kind == 'theme' and asset.size <= INLINE_IMAGE_MAX_SIZE \
+                    and make_stupid_mimetype_guess(file) in INLINE_IMAGE_MIMETYPES:
+                if prefix.endswith(HTTPSERVER_BASE_URL):
+                    prefix = prefix[:-len(HTTPSERVER_BASE_URL)]
+                return prefix + make_data_uri(asset.path, asset.data)
+            if processed is not asset:
+                # Embedded images belong to this theme.
+                asset = processed
+            elif kind == 'theme':
+                # Files shared by several themes get the same URL for all of them.
+                shared_url = self._share_theme_asset(asset)
+                if shared_url is not None:
+                    return prefix + shared_url
+            query = urllib.urlencode(params + [('v', asset.digest)]).replace('&', '&amp;')
+            return '{0}/{1}/{2}?{3}'.format(prefix, kind, file, query)
+
+        return VERSIONABLE_URL_RE.sub(replace, page)
+
+    def get_stats(self):
+        stats = SmallWebFramework.get_stats(self)
+        stats['readiness'] = self.readiness.get_stats()
+        stats['assets'] = self.assets.get_stats()
+        stats['theme_contents'] = self._melange.theme_contents.get_stats()
+        stats['events'] = self.events.get_stats()
+        stats['images'] = self.images.get_stats()
+        stats['proxy'] = self.proxy.get_stats()
+        stats['skins'] = self.skins.get_stats()
+        return stats
 
     @route(r'/data/(?P<file>.*)')
     def data_files(self, GET, file):
-        return open(os.path.join(self._melange.widgets[GET['instance']].get_data_path(), file))
+        path = os.path.join(self._get_widget(GET['instance']).get_data_path(), file)
+        if ('w' in GET or 'h' in GET or 'q' in GET) and file.lower().endswith(IMAGE_EXTENSIONS):
+            # Scaled down copy of an image, e.g. /data/photo.jpg?w=200&h=150&q=80
+            try:
+                width, height, quality = [int(GET[key]) if key in GET else None for key in 'whq']
+            except ValueError:
+                return Response('Bad Request', '400 Bad Request')
+            if not all(value is None or 0 < value <= limit for value, limit in
+                       ((width, IMAGE_MAX_DIMENSION), (height, IMAGE_MAX_DIMENSION), (quality, 100))):
+                return Response('Bad Request', '400 Bad Request')
+            path = self.images.get(path, width, height, quality)
+        return open(path, 'rb')
 
     @route(r'/widget/(?P<file>.*)')
     def widget_files(self, GET, file):
-        return open(os.path.join(self._melange.widgets[GET['instance']].get_skin_path(), file))
+        response = self._serve_cached(self._get_widget(GET['instance']).get_skin_path(), file)
+        if isinstance(response, Asset) and file.endswith('.html'):
+            response = self._prepare_page(response, GET)
+        return response
+
+    # Routes are tried in the order they are declared in, so this one has to
+    # come before `theme_files`.
+    @route(r'/theme/_bundle\.(?:js|css)$')
+    def bundle_files(self, GET):
+        bundle = self.bundles.get(GET.get('v'))
+        if bundle is None:
+            return Response('Not Found', '404 Not Found')
+        return bundle
+
+    # Like `bundle_files`, this has to come before `theme_files`.
+    @route(r'/theme/_content/')
+    def content_files(self, GET):
+        digest = GET.get('v')
+        path = self._melange.theme_contents.get_path(digest)
+        if path is not None:
+            try:
+                asset = self.assets.get(path)
+            except (IOError, OSError):
+                asset = None
+            if asset is not None and asset.digest == digest:
+                return asset
+            self._melange.theme_contents.discard(path)
+        return Response('Not Found', '404 Not Found')
+
+    @route(r'/events$')
+    def event_stream(self, GET):
+        if self.backend != 'threaded':
+            # Streams would block a single-threaded server.
+            return Response('Not Implemented', '501 Not Implemented')
+        self._get_widget(GET['instance'])
+        headers = [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache')]
+        return Response(self.events.get(GET['instance']).stream(), headers=headers)
+
+    @route(r'/proxy$', methods=('GET', 'HEAD'))
+    def proxy_files(self, GET):
+        # Only widget pages may use the proxy.
+        try:
+            self._get_widget(GET['instance'])
+        except KeyError:
+            return Response('Forbidden', '403 Forbidden')
+        url = GET.get('url', '')
+        if urlparse.urlparse(url).scheme not in ('http', 'https'):
+            return Response('Bad Request', '400 Bad Request')
+        try:
+            response = self.proxy.get(url)
+        except TooLarge:
+            # Not worth caching, the page loads it directly instead.
+            return Response('Found', '302 Found', [('Location', url)])
+        except ProxyError, e:
+            sys.stderr.write('{0}\n'.format(e))
+            return Response('Bad Gateway', '502 Bad Gateway')
+
+        status = '{0} {1}'.format(response.status, httplib.responses.get(response.status, 'Unknown'))
+        headers = list(response.headers)
+        if response.data is not None:
+            return Response(response.data, status, headers + [('Cache-Control', 'no-cache')])
+        file_ = response.open()
+        max_age = max(0, int(response.expires - time.time()))
+        headers.extend([
+            ('Content-Length', str(os.fstat(file_.fileno()).st_size)),
+            ('Cache-Control', 'max-age={0}'.format(max_age))
+        ])
+        return Response(FileBlocks(file_, HTTPSERVER_FILE_BLOCK_SIZE), status, headers)
 
     @route(r'/common/(?P<file>.*)')
     def common_files(self, GET, file):
-        path = os.path.join(self._melange.context.get_path(), 'data/common')
-        return open(os.path.join(path, file))
+        return self._serve_cached(self._get_common_path(), file)
 
     @route(r'/theme/(?P<file>.*)')
     def theme_files(self, GET, file):
         widget_theme = self._get_widget_theme(GET)
-        return open(os.path.join(widget_theme['path'], file))
+        root = widget_theme['path']
+        return self._get_theme_asset(root, file) or open(os.path.join(root, file), 'rb')
@@ -0,0 +1,194 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import os
+import hashlib
+import tempfile
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from melange.common import IMAGE_SCALER_WORKERS, IMAGE_SCALE_TIMEOUT, IMAGE_CACHE_SIZE
+
+# Files that can be scaled:
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+def scale_image(source, destination, width, height, quality):
+    """
+    Scale the image `source` down to fit into `width` x `height` and save it
+    to `destination`. Images with an alpha channel are saved as PNG, all
+    others as JPEG with the given quality.
+
+    :return: The path of the saved file or `None` if `source` needs no scaling.
+    """
+
+    import gtk.gdk
+
+    format, source_width, source_height = gtk.gdk.pixbuf_get_file_info(source)
+    width = min(width or source_width, source_width)
+    height = min(height or source_height, source_height)
+    if (width, height) == (source_width, source_height) and quality is None:
+        return None
+
+    pixbuf = gtk.gdk.pixbuf_new_from_file_at_size(source, width, height)
+    if pixbuf.get_has_alpha():
+        destination += '.png'
+        pixbuf.save(destination, 'png')
+    else:
+        destination += '.jpg'
+        pixbuf.save(destination, 'jpeg', {'quality': str(quality or 90)})
+    return destination
+
+
+class ImageScaler(object):
+    """
+    Scales images in a pool of worker threads and keeps the results in an
+    on-disk cache. Cache entries are named after the source's path, size and
+    modification time and the requested bounds, so changed files are scaled
+    again; the least recently created entries are removed once the cache
+    grows larger than `IMAGE_CACHE_SIZE`.
+    """
+
+    def __init__(self, cache_dir, workers=IMAGE_SCALER_WORKERS, scale=scale_image):
+
+        self.cache_dir = cache_dir
+        self.scale = scale
+
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.timeouts = 0
+        # Set once it turns out there's nothing to scale images with.
+        self.available = True
+
+        self._pool = None
+        self._workers = workers
+        self._pending = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, path, width=None, height=None, quality=None):
+        """
+        Get the path of a copy of the image at `path` that fits into `width`
+        x `height`. The copy is created by a worker if it isn't cached.
+
+        :return: The path of the copy or `path` if there's no need to scale
+                 the image, it can't be scaled or doing so takes too long.
+        """
+
+        if not self.available:
+            return path
+
+        stat = os.stat(path)
+        key = hashlib.sha1(repr((os.path.realpath(path), stat.st_size, stat.st_mtime,
+                                 width, height, quality))).hexdigest()
+        destination = os.path.join(self.cache_dir, key)
+
+        for cached in (destination + '.jpg', destination + '.png', destination + '.orig'):
+            if os.path.exists(cached):
+                with self._lock:
+                    self.hits += 1
+                return path if cached.endswith('.orig') else cached
+
+        with self._lock:
+            self.misses += 1
+            result = self._pending.get(key)
+            if result is None:
+                if self._pool is None:
+                    self._pool = ThreadPool(self._workers)
+                result = self._pending[key] = self._pool.apply_async(
+                    self._scale, (key, path, destination, width, height, quality))
+
+        # `wait` without a timeout can't be interrupted.
+        result.wait(IMAGE_SCALE_TIMEOUT)
+        if not result.ready():
+            with self._lock:
+                self.timeouts += 1
+            return path
+        return result.get() or path
+
+
+    def _scale(self, key, path, destination, width, height, quality):
+
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            handle, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.scaling-')
+            os.close(handle)
+            try:
+                scaled = self.scale(path, temp_path, width, height, quality)
+                if scaled is None:
+                    # Remember that the original is to be served.
+                    os.rename(temp_path, destination + '.orig')
+                    return None
+                extension = os.path.splitext(scaled)[1]
+                os.rename(scaled, destination + extension)
+                self._prune()
+                return destination + extension
+            finally:
+                for leftover in (temp_path, temp_path + '.jpg', temp_path + '.png'):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+        except ImportError:
+            self.available = False
+            return None
+        except Exception:
+            traceback.print_exc()
+            with self._lock:
+                self.failures += 1
+            return None
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+
+    def _prune(self):
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, name in sorted(entries):
+            if size <= IMAGE_CACHE_SIZE:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            size -= entry_size
+
+
+    def get_stats(self):
+
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'pending': len(self._pending),
+                'available': self.available
+            }
@@ -0,0 +1,448 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import os
+import json
+import time
+import socket
+import httplib
+import hashlib
+import urlparse
+import tempfile
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+from melange.common import PROXY_CACHE_SIZE, PROXY_MAX_ENTRY_SIZE, PROXY_TIMEOUT, \
+                           PROXY_MAX_IDLE_CONNECTIONS, PROXY_MAX_REDIRECTS
+
+# Upstream headers passed on to the widget:
+FORWARDED_HEADERS = ('content-type', 'content-encoding', 'content-language', 'last-modified', 'etag')
+
+# Upper bound for the freshness guessed from Last-Modified:
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+
+BLOCK_SIZE = 64 * 1024
+
+
+class ProxyError(Exception):
+    pass
+
+
+class TooLarge(ProxyError):
+    """ Raised for responses too large to be cached. """
+
+
+def parse_cache_control(value):
+    """ Parse a Cache-Control header into a `dict` of directives. """
+
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def parse_date(value):
+
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed is not None else None
+
+
+def get_expiry(headers, now):
+    """
+    Compute when a response with the given (lowercase) headers, received at
+    `now`, stops being fresh.
+
+    :return: The expiry time or `None` if the response must not be stored.
+    """
+
+    cache_control = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return now
+
+    date = parse_date(headers.get('date')) or now
+    age = max(0, now - date)
+    try:
+        age = max(age, int(headers.get('age', 0)))
+    except ValueError:
+        pass
+
+    if cache_control.get('max-age') is not None:
+        try:
+            return now + int(cache_control['max-age']) - age
+        except ValueError:
+            return now
+    if 'expires' in headers:
+        expires = parse_date(headers['expires'])
+        return now + expires - date if expires is not None else now
+
+    last_modified = parse_date(headers.get('last-modified'))
+    if last_modified is not None:
+        return now + min((date - last_modified) / 10, MAX_HEURISTIC_FRESHNESS) - age
+    return now
+
+
+class ConnectionPool(object):
+    """ Keeps idle connections to upstream servers for reuse. """
+
+    def __init__(self, max_idle=PROXY_MAX_IDLE_CONNECTIONS, timeout=PROXY_TIMEOUT):
+
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+
+        self._idle = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, scheme, netloc):
+        """
+        Get a connection to `netloc`.
+
+        :return: The connection and whether it has been used before.
+        """
+
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.created += 1
+
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return connection_class(netloc, timeout=self.timeout), False
+
+
+    def put(self, scheme, netloc, connection):
+        """ Give back a connection whose response has been read completely. """
+
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+    def get_stats(self):
+
+        with self._lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'idle': sum(len(idle) for idle in self._idle.itervalues())
+            }
+
+
+class CachedResponse(object):
+    """ An upstream response whose body is stored in a file. """
+
+    def __init__(self, status, headers, path, expires, url, data=None):
+
+        self.status = status
+        self.headers = headers
+        self.path = path
+        self.expires = expires
+        self.url = url
+        # The body of responses that aren't stored.
+        self.data = data
+
+
+    def open(self):
+        return open(self.path, 'rb')
+
+
+    def is_fresh(self, now):
+        return self.expires is not None and now < self.expires
+
+
+class ProxyCache(object):
+    """
+    Fetches external resources and keeps them in a bounded on-disk cache,
+    honouring the freshness information of the responses. Concurrent
+    requests for the same URL are served by a single upstream request.
+    """
+
+    def __init__(self, cache_dir, max_size=PROXY_CACHE_SIZE, pool=None):
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.pool = pool if pool is not None else ConnectionPool()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.coalesced = 0
+        self.errors = 0
+
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+
+    def _get_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+
+    def _load(self, url):
+
+        entry = self._entries.get(url)
+        if entry is None:
+            path = self._get_path(url)
+            try:
+                with open(path + '.json') as file_:
+                    meta = json.load(file_)
+            except (IOError, ValueError):
+                return None
+            if meta.get('url') != url or not os.path.exists(path):
+                return None
+            entry = CachedResponse(meta['status'], [tuple(h) for h in meta['headers']],
+                                   path, meta['expires'], url)
+            self._entries[url] = entry
+        return entry
+
+
+    def get(self, url):
+        """
+        Get the response for `url`, from the cache if it is fresh.
+
+        :rtype: `CachedResponse`
+        :raises ProxyError: If the resource can't be fetched.
+        """
+
+        now = time.time()
+        with self._lock:
+            entry = self._load(url)
+            if entry is not None and entry.is_fresh(now):
+                self.hits += 1
+                return entry
+
+            inflight = self._inflight.get(url)
+            if inflight is None:
+                inflight = self._inflight[url] = {'done': threading.Event()}
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            inflight['done'].wait()
+            if 'error' in inflight:
+                raise inflight['error']
+            return inflight['response']
+
+        try:
+            inflight['response'] = self._fetch(url, entry)
+            return inflight['response']
+        except Exception, e:
+            if not isinstance(e, ProxyError):
+                e = ProxyError('Fetching {0} failed: {1}'.format(url, e))
+            inflight['error'] = e
+            with self._lock:
+                self.errors += 1
+            raise e
+        finally:
+            with self._lock:
+                del self._inflight[url]
+            inflight['done'].set()
+
+
+    def _fetch(self, url, entry):
+
+        headers = {}
+        if entry is not None:
+            stored = dict((name.lower(), value) for name, value in entry.headers)
+            if 'etag' in stored:
+                headers['If-None-Match'] = stored['etag']
+            if 'last-modified' in stored:
+                headers['If-Modified-Since'] = stored['last-modified']
+
+        location = url
+        for _ in xrange(PROXY_MAX_REDIRECTS + 1):
+            response, finish = self._request(location, headers)
+            status = response.status
+            response_headers = dict((name.lower(), value) for name, value in response.getheaders())
+            if status in (301, 302, 303, 307, 308) and 'location' in response_headers:
+                response.read()
+                finish()
+                location = urlparse.urljoin(location, response_headers['location'])
+                # Validators belong to the original URL.
+                headers = {}
+                continue
+            break
+        else:
+            raise ProxyError('Too many redirects: {0}'.format(url))
+
+        now = time.time()
+        expires = get_expiry(response_headers, now)
+
+        if status == 304 and entry is not None:
+            response.read()
+            finish()
+            with self._lock:
+                self.revalidations += 1
+                entry.expires = expires
+                self._store_meta(entry)
+            return entry
+
+        with self._lock:
+            self.misses += 1
+
+        forwarded = [(name.title(), value) for name, value in response_headers.iteritems()
+                     if name in FORWARDED_HEADERS]
+
+        try:
+            if int(response_headers.get('content-length', 0)) > PROXY_MAX_ENTRY_SIZE:
+                finish(reuse=False)
+                raise TooLarge('Too large: {0}'.format(url))
+        except ValueError:
+            pass
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        handle, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.fetching-')
+        try:
+            size = 0
+            with os.fdopen(handle, 'wb') as file_:
+                while True:
+                    block = response.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    size += len(block)
+                    if size > PROXY_MAX_ENTRY_SIZE:
+                        # Don't read the rest, the connection can't be reused.
+                        finish(reuse=False)
+                        raise TooLarge('Too large: {0}'.format(url))
+                    file_.write(block)
+            finish()
+        except (socket.error, httplib.HTTPException, ProxyError), e:
+            os.remove(temp_path)
+            if isinstance(e, ProxyError):
+                raise
+            raise ProxyError('Fetching {0} failed: {1}'.format(url, e))
+
+        if status != 200 or expires is None:
+            with open(temp_path, 'rb') as file_:
+                data = file_.read()
+            os.remove(temp_path)
+            return CachedResponse(status, forwarded, None, None, url, data)
+
+        path = self._get_path(url)
+        os.rename(temp_path, path)
+        entry = CachedResponse(status, forwarded, path, expires, url)
+        with self._lock:
+            self._entries[url] = entry
+            self._store_meta(entry)
+        self._prune()
+        return entry
+
+
+    def _request(self, url, headers):
+        """
+        Send a GET request for `url` on a pooled connection.
+
+        :return: The response and a function to call once it has been read
+                 (or with ``reuse=False`` if it won't be read completely).
+        """
+
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise ProxyError('Unsupported URL: {0}'.format(url))
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        while True:
+            connection, reused = self.pool.get(parsed.scheme, parsed.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                if reused:
+                    # The server may have closed the idle connection.
+                    continue
+                raise ProxyError('Fetching {0} failed: {1}'.format(url, e))
+
+            def finish(connection=connection, response=response, reuse=True):
+                if not reuse or response.will_close:
+                    connection.close()
+                else:
+                    self.pool.put(parsed.scheme, parsed.netloc, connection)
+
+            return response, finish
+
+
+    def _store_meta(self, entry):
+
+        meta = {
+            'url': entry.url,
+            'status': entry.status,
+            'headers': entry.headers,
+            'expires': entry.expires
+        }
+        with open(entry.path + '.json', 'w') as file_:
+            json.dump(meta, file_)
+
+
+    def _prune(self):
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.') or name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            with self._lock:
+                for url, entry in self._entries.items():
+                    if entry.path == path:
+                        del self._entries[url]
+            for leftover in (path, path + '.json'):
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+            size -= entry_size
+
+
+    def get_stats(self):
+
+        with self._lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'entries': len(self._entries)
+            }
+        stats['connections'] = self.pool.get_stats()
+        return stats
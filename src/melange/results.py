@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import time
+import threading
+from collections import OrderedDict
+
+from melange.common import API_RESULT_CACHE_SIZE
+
+# Returned by `ResultCache.get` for keys without a (fresh) result:
+MISSING = object()
+
+# Types of the values keys may be made of:
+PRIMITIVE_TYPES = (type(None), bool, int, long, float, str, unicode)
+
+
+def is_primitive(value):
+    """
+    Check whether `value` is made of primitive values only. Other objects
+    (like those passed by JS) are compared by identity, so keys containing
+    them would never be found again.
+    """
+
+    if isinstance(value, tuple):
+        return all(is_primitive(item) for item in value)
+    return isinstance(value, PRIMITIVE_TYPES)
+
+
+class ResultCache(object):
+    """
+    A least recently used cache for the results of an exposed method. Results
+    expire `ttl` seconds after they were stored (never if `ttl` is `None`).
+    """
+
+    def __init__(self, ttl=None, maxsize=None, key=None):
+        """
+        :param key: Function computing the key from the call's arguments. It
+                    may return `None` for calls whose result must not be
+                    cached. The arguments themselves are used by default.
+                    Keys containing anything but numbers, strings, `None`
+                    and tuples of them aren't cached.
+        """
+
+        self.ttl = ttl
+        self.maxsize = maxsize if maxsize is not None else API_RESULT_CACHE_SIZE
+        self.key = key
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def make_key(self, args):
+        """
+        Get the key of a call with the arguments `args`.
+
+        :return: The key or `None` if the result can't be cached.
+        """
+
+        key = self.key(*args) if self.key is not None else args
+        return key if is_primitive(key) else None
+
+
+    def get(self, key):
+        """ Get the result stored for `key` or `MISSING`. """
+
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is None or (entry[0] is not None and entry[0] <= time.time()):
+                self.misses += 1
+                return MISSING
+            # Move to the end, it is the most recently used one now.
+            self._results[key] = entry
+            self.hits += 1
+            return entry[1]
+
+
+    def put(self, key, result):
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (expires, result)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+                self.evictions += 1
+
+
+    def invalidate(self, key=MISSING):
+        """ Drop the result stored for `key` or, without a key, all results. """
+
+        with self._lock:
+            if key is MISSING:
+                self._results.clear()
+            else:
+                self._results.pop(key, None)
+
+
+    def get_stats(self):
+
+        with self._lock:
+            return {
+                'entries': len(self._results),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import os
+import re
+import urlparse
+import threading
+
+from melange.assets import CSS_URL_RE, make_data_uri, make_stupid_mimetype_guess, rebase_css_urls
+from melange.bundle import SCRIPT_TAG_RE, STYLESHEET_TAG_RE
+from melange.common import INLINE_IMAGE_MAX_SIZE
+
+IMAGE_TAG_RE = re.compile(r'''(<img\b[^>]*?\bsrc\s*=\s*["'])([^"']+)(["'])''', re.I)
+
+# Maximum number of compiled skins kept around:
+MAX_COMPILED_SKINS = 64
+
+
+def is_local(url):
+    """ Check whether `url` is relative to the page (and not to the server). """
+
+    parsed = urlparse.urlparse(url)
+    return not parsed.scheme and not parsed.netloc and not parsed.path.startswith('/') \
+           and bool(parsed.path)
+
+
+class SkinCompiler(object):
+    """
+    Turns a skin's page into a single document: the skin's own scripts and
+    style sheets are inlined and small images are embedded as data URIs.
+    References to files below /common and /theme are left alone.
+
+    Compiled pages are cached and rebuilt when the page or any of the files
+    inlined into it change.
+    """
+
+    def __init__(self, read=None):
+
+        self.read = read or self._read
+        self.hits = 0
+        self.misses = 0
+
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as file_:
+            return file_.read()
+
+
+    def compile(self, root, page_path, page, base_url):
+        """
+        Compile the skin page `page`.
+
+        :param root: The skin's directory; files outside of it aren't inlined.
+        :param page_path: Path of the page's file.
+        :param page: The page's contents.
+        :param base_url: URL the skin's directory is served at, e.g. ``/widget/``.
+
+        :return: The compiled page.
+        """
+
+        cached = self._compiled.get(page_path)
+        if cached is not None and cached[0] == page and self._is_current(cached[1]):
+            with self._lock:
+                self.hits += 1
+            return cached[2]
+
+        dependencies = []
+        compiled = self._compile(root, page_path, page, base_url, dependencies)
+
+        with self._lock:
+            self.misses += 1
+            if len(self._compiled) >= MAX_COMPILED_SKINS:
+                self._compiled.clear()
+            self._compiled[page_path] = (page, dependencies, compiled)
+        return compiled
+
+
+    def _is_current(self, dependencies):
+
+        for path, mtime, size in dependencies:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if (stat.st_mtime, stat.st_size) != (mtime, size):
+                return False
+        return True
+
+
+    def _resolve(self, root, base_path, url):
+        """
+        Resolve the local reference `url` made by the file at `base_path`.
+
+        :return: The referenced file's path or `None` if it's not a local file.
+        """
+
+        if not is_local(url):
+            return None
+        path = urlparse.urlparse(url).path
+        path = os.path.normpath(os.path.join(os.path.dirname(base_path), urlparse.unquote(path)))
+        if not path.startswith(root.rstrip(os.sep) + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+
+    def _load(self, path, dependencies):
+
+        data = self.read(path)
+        stat = os.stat(path)
+        dependencies.append((path, stat.st_mtime, stat.st_size))
+        return data
+
+
+    def _embed_image(self, path, dependencies):
+
+        if os.path.getsize(path) > INLINE_IMAGE_MAX_SIZE:
+            return None
+        if not (make_stupid_mimetype_guess(path) or '').startswith('image/'):
+            return None
+        return make_data_uri(path, self._load(path, dependencies))
+
+
+    def _compile(self, root, page_path, page, base_url, dependencies):
+
+        root = os.path.realpath(root)
+        page_path = os.path.realpath(page_path)
+
+        def url_for(path):
+            return urlparse.urljoin(base_url, os.path.relpath(path, root).replace(os.sep, '/'))
+
+        def inline_script(match):
+            path = self._resolve(root, page_path, match.group(1))
+            if path is None:
+                return match.group(0)
+            script = re.sub(r'(?i)</(script)', r'<\\/\1', self._load(path, dependencies))
+            return '<script type="text/javascript">\n{0}\n</script>\n'.format(script.rstrip())
+
+        def inline_stylesheet(match):
+            path = self._resolve(root, page_path, match.group(1))
+            if path is None:
+                return match.group(0)
+            css = self._load(path, dependencies)
+
+            def embed(url_match):
+                url = url_match.group(2)
+                image = url is not None and self._resolve(root, path, url)
+                data_uri = image and self._embed_image(image, dependencies)
+                if data_uri:
+                    return 'url("{0}")'.format(data_uri)
+                return url_match.group(0)
+
+            css = rebase_css_urls(CSS_URL_RE.sub(embed, css), url_for(path))
+            css = re.sub(r'(?i)</(style)', r'<\\/\1', css)
+            return '<style type="text/css">\n{0}\n</style>\n'.format(css.rstrip())
+
+        def embed_image(match):
+            path = self._resolve(root, page_path, match.group(2))
+            data_uri = path and self._embed_image(path, dependencies)
+            if not data_uri:
+                return match.group(0)
+            return match.group(1) + data_uri + match.group(3)
+
+        page = SCRIPT_TAG_RE.sub(inline_script, page)
+        page = STYLESHEET_TAG_RE.sub(inline_stylesheet, page)
+        page = IMAGE_TAG_RE.sub(embed_image, page)
+
+        stat = os.stat(page_path)
+        dependencies.append((page_path, stat.st_mtime, stat.st_size))
+        return page
+
+
+    def get_stats(self):
+
+        with self._lock:
+            return {
+                'compiled': len(self._compiled),
+                'hits': self.hits,
+                'misses': self.misses
+            }
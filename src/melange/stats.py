@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import time
+import bisect
+import threading
+from collections import defaultdict
+
+# Upper bounds (in seconds) of the latency histogram's buckets; the last
+# bucket takes everything slower.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+
+class Histogram(object):
+    """ A latency histogram with fixed buckets. """
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+    def add(self, value):
+
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+    def to_dict(self):
+
+        buckets = [str(bound) for bound in LATENCY_BUCKETS] + ['inf']
+        return {
+            'buckets': dict(zip(buckets, self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max
+        }
+
+
+class Counters(object):
+    """ Request counters of a single route or instance. """
+
+    __slots__ = ('requests', 'statuses', 'bytes_sent', 'dispatch', 'streaming')
+
+    def __init__(self):
+
+        self.requests = 0
+        self.statuses = defaultdict(int)
+        self.bytes_sent = 0
+        self.dispatch = Histogram()
+        self.streaming = Histogram()
+
+
+    def add(self, status, bytes_sent, dispatch_time, streaming_time):
+
+        self.requests += 1
+        self.statuses[status] += 1
+        self.bytes_sent += bytes_sent
+        self.dispatch.add(dispatch_time)
+        if streaming_time is not None:
+            self.streaming.add(streaming_time)
+
+
+    def to_dict(self):
+
+        return {
+            'requests': self.requests,
+            'statuses': dict(self.statuses),
+            'bytes_sent': self.bytes_sent,
+            'dispatch': self.dispatch.to_dict(),
+            'streaming': self.streaming.to_dict()
+        }
+
+
+class RequestStats(object):
+    """ Thread-safe request statistics per route and per widget instance. """
+
+    def __init__(self):
+
+        self._routes = defaultdict(Counters)
+        self._instances = defaultdict(Counters)
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+
+    def record(self, route, instance, status, bytes_sent, dispatch_time, streaming_time=None):
+        """
+        Record a served request.
+
+        :param route: Name of the route.
+        :param instance: The requesting widget instance or `None` (for
+                         requests of unknown instances, too).
+        :param status: The response's status code.
+        :param bytes_sent: Size of the response body.
+        :param dispatch_time: Seconds until the response body was returned.
+        :param streaming_time: Seconds spent sending the body, if known.
+        """
+
+        with self._lock:
+            self._routes[route].add(status, bytes_sent, dispatch_time, streaming_time)
+            self._instances[instance or '-'].add(status, bytes_sent, dispatch_time, streaming_time)
+
+
+    def forget(self, instance):
+        """ Drop the statistics of a widget instance that has been removed. """
+
+        with self._lock:
+            self._instances.pop(instance, None)
+
+
+    def get_stats(self):
+
+        with self._lock:
+            return {
+                'uptime': time.time() - self.started,
+                'routes': dict((name, c.to_dict()) for name, c in self._routes.iteritems()),
+                'instances': dict((name, c.to_dict()) for name, c in self._instances.iteritems())
+            }
+
+
+class RecordingBody(object):
+    """ Wraps a response body to measure how long sending it takes. """
+
+    def __init__(self, body, record):
+
+        self.body = body
+        self.record = record
+        self.bytes_sent = 0
+        self.start = time.time()
+
+
+    def __iter__(self):
+
+        for data in self.body:
+            self.bytes_sent += len(data)
+            yield data
+
+
+    def close(self):
+
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.record(self.bytes_sent, time.time() - self.start)
@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import re
+import posixpath
+import threading
+
+from melange.assets import Asset, CSS_URL_RE, make_data_uri, make_stupid_mimetype_guess
+from melange.common import HTTPSERVER_BASE_URL, INLINE_IMAGE_MAX_SIZE
+
+# Quoted references to theme images in scripts (and the HTML they build):
+SCRIPT_IMAGE_RE = re.compile(
+    r'''(["'])((?:{0})?/theme/[^"'\s?#]+\.(?:png|gif|jpe?g))\1'''.format(re.escape(HTTPSERVER_BASE_URL)))
+
+# Maximum number of processed files kept around:
+MAX_PROCESSED_FILES = 256
+
+
+def theme_file_for_url(url, referrer):
+    """
+    Get the theme file `url` refers to, relative to the theme's directory.
+
+    :param url: The reference.
+    :param referrer: The referring theme file, for relative references.
+
+    :return: The file or `None` if `url` doesn't refer to a theme file.
+    """
+
+    if url.startswith(HTTPSERVER_BASE_URL):
+        url = url[len(HTTPSERVER_BASE_URL):]
+    if url.startswith('/theme/'):
+        file = url[len('/theme/'):]
+    elif ':' in url or url.startswith('/'):
+        return None
+    else:
+        file = posixpath.join(posixpath.dirname(referrer), url)
+    file = posixpath.normpath(file.split('?', 1)[0].split('#', 1)[0])
+    return None if file.startswith('..') else file
+
+
+class ThemeImageInliner(object):
+    """
+    Embeds the small images a theme's style sheets and scripts refer to as
+    data URIs, so widgets don't fetch them one by one. References to other
+    files can be replaced by URLs shared by all widgets. Processed files are
+    cached and rebuilt when the file or one of the referenced files changes.
+    """
+
+    def __init__(self, max_size=INLINE_IMAGE_MAX_SIZE):
+
+        self.max_size = max_size
+        self._processed = {}
+        self._lock = threading.Lock()
+
+
+    def process(self, asset, file, get_asset, share=None):
+        """
+        Embed the images referenced by the theme file `asset`.
+
+        :param file: The file's path relative to the theme's directory.
+        :param get_asset: Function returning the `Asset` of another file of
+                          the theme (or `None` if it's too large to be cached).
+        :param share: Function returning the URL all widgets may use for the
+                      `Asset` of a file that isn't embedded (or `None`).
+
+        :return: The processed asset or `asset` if nothing was replaced.
+        """
+
+        cached = self._processed.get(asset.path)
+        if cached is not None and cached[0] == asset.digest and self._is_current(cached[1], get_asset):
+            return cached[2]
+
+        embedded = {}
+
+        def embed(url):
+            image_file = theme_file_for_url(url, file)
+            if image_file is None:
+                return None
+            try:
+                image = get_asset(image_file)
+            except (IOError, OSError):
+                return None
+            if image is None:
+                return None
+            if image.size <= self.max_size and \
+                    (make_stupid_mimetype_guess(image_file) or '').startswith('image/'):
+                embedded[image_file] = image.digest
+                return make_data_uri(image.path, image.data)
+            shared_url = share(image) if share is not None else None
+            if shared_url is not None:
+                embedded[image_file] = image.digest
+            return shared_url
+
+        def replace_css_url(match):
+            new_url = match.group(2) is not None and embed(match.group(2))
+            return 'url("{0}")'.format(new_url) if new_url else match.group(0)
+
+        def replace_script_string(match):
+            new_url = embed(match.group(2))
+            return match.group(1) + new_url + match.group(1) if new_url else match.group(0)
+
+        if file.endswith('.css'):
+            data = CSS_URL_RE.sub(replace_css_url, asset.data)
+        else:
+            data = SCRIPT_IMAGE_RE.sub(replace_script_string, asset.data)
+
+        processed = Asset(asset.path, data, asset.mtime) if embedded else asset
+
+        with self._lock:
+            if len(self._processed) >= MAX_PROCESSED_FILES:
+                self._processed.clear()
+            self._processed[asset.path] = (asset.digest, embedded, processed)
+        return processed
+
+
+    def _is_current(self, embedded, get_asset):
+
+        for image_file, digest in embedded.iteritems():
+            try:
+                image = get_asset(image_file)
+            except (IOError, OSError):
+                return False
+            if image is None or image.digest != digest:
+                return False
+        return True
@@ -20,7 +20,10 @@ import sys
 import os
 import imp
 import shutil
+import base64
 import weakref
+import urllib
+import urlparse
 
 import gobject
 import gtk
@@ -32,11 +35,12 @@ import cream.base
 import cream.gui
 from cream.util import cached_property, random_hash, extend_querystring
 from melange.api import APIS, PyToJSInterface
+from melange.assets import rebase_css_urls
 
 from cream.config import Configuration
 from gpyconf.fields import MultiOptionField
 
-from common import HTTPSERVER_BASE_URL, \
+from common import HTTPSERVER_BASE_URL, INPROCESS_MAX_SIZE, \
                    STATE_MOVE, STATE_NONE, STATE_VISIBLE, \
                    MOUSE_BUTTON_LEFT, MOUSE_BUTTON_MIDDLE, MOUSE_BUTTON_RIGHT, \
                    MOVE_TIMESTEP, OPACITY_MOVE
@@ -169,10 +173,42 @@ class WidgetInstance(gobject.GObject):
         self.js_context.melange.show_add_widget_dialog = self.widget_ref().__melange_ref__().add_widget
         self.js_context.melange.show_settings_dialog = self.widget_ref().__melange_ref__().config.show_dialog
 
-        skin_url = HTTPSERVER_BASE_URL + '/widget/index.html'
-        self.view.open(skin_url)
+        if self.inprocess:
+            # The widget isn't registered yet, so wait for the main loop.
+            gobject.idle_add(self.load_skin_inprocess)
+        else:
+            self.view.open(HTTPSERVER_BASE_URL + '/widget/index.html')
+
+
+    @property
+    def inprocess(self):
+        """ Whether resources are loaded directly from the HTTP server object. """
+
+        return self.widget_ref().__melange_ref__().config.inprocess_resources
+
+
+    @property
+    def proxy_external(self):
+        """ Whether external resources are loaded through the HTTP server's cache. """
+
+        return self.widget_ref().__melange_ref__().config.proxy_external_resources
+
+
+    def fetch_inprocess(self, uri, max_size=None):
+        """ Serve a request for `uri` using the HTTP server object, see `HttpServer.fetch`. """
+
+        server = self.widget_ref().__melange_ref__().server
+        url = urlparse.urlparse(uri)
+        return server.fetch(url.path, url.query, max_size)
 
-        gobject.timeout_add(250, self.apply_hack_to_avoid_problems_with_caching)
+
+    def load_skin_inprocess(self):
+
+        skin_url = HTTPSERVER_BASE_URL + '/widget/index.html'
+        uri = extend_querystring(skin_url, {'instance': self.widget_ref().instance_id})
+        status, headers, body = self.fetch_inprocess(uri)
+        self.view.load_string(body, 'text/html', 'utf-8', skin_url)
+        return False
 
 
     def drag_motion_cb(self, widget, context, x, y, time):
@@ -204,19 +240,6 @@ class WidgetInstance(gobject.GObject):
             context.finish(True, False, time)
 
 
-    # evil black magic, but it fixes caching problems
-    # adds some randomness to each link, style, script, whatsoever
-    def apply_hack_to_avoid_problems_with_caching(self):
-        if hasattr(self.js_context.document.head, 'childNodes'):
-            for element in self.js_context.document.head.childNodes.values():
-                if hasattr(element, 'src') and element.src:
-                    url = extend_querystring(element.src, {'query_id': random_hash()[:5]})
-                    element.src = url
-                elif hasattr(element, 'href') and element.href:
-                    url = extend_querystring(element.href, {'query_id': random_hash()[:5]})
-                    element.href = url
-            return False
-
     def log(self, msg):
         self.messages.debug(msg)
 
@@ -233,6 +256,18 @@ class WidgetInstance(gobject.GObject):
 
 
     def init_api(self):
+        """
+        Load the widget's Python API.
+
+        :return: The URL of the page's event stream or `None` if events
+                 published by the API are delivered differently.
+        """
+
+        melange = self.widget_ref().__melange_ref__()
+        if self.inprocess or melange.config.http_backend != 'threaded':
+            event_channel = None
+        else:
+            event_channel = melange.server.events.get(self.widget_ref().instance_id)
 
         custom_api_file = os.path.join(self.widget_ref().context.get_path(), '__init__.py')
         if os.path.isfile(custom_api_file):
@@ -246,6 +281,7 @@ class WidgetInstance(gobject.GObject):
             for name, value in APIS[custom_api_file].iteritems():
                 c = value
                 c._js_ctx = self.js_context
+                c._event_channel = event_channel
                 c._data_path = self.widget_ref().get_data_path()
                 c.context = self.widget_ref().context
                 c.config = self.config.config_ref()
@@ -254,10 +290,59 @@ class WidgetInstance(gobject.GObject):
                 self.js_context.widget.api.__setattr__(name, i)
             del sys.path[0]
 
+            if event_channel is not None:
+                return extend_querystring(HTTPSERVER_BASE_URL + '/events',
+                                          {'instance': self.widget_ref().instance_id})
+
+
+    def is_proxied(self, frame, request, response):
+        """ Whether `request` is for an external resource to be fetched through the proxy. """
+
+        uri = request.get_property('uri')
+        # In-process requests are served in the main loop, so external
+        # resources aren't fetched through the proxy then.
+        if not self.proxy_external or self.inprocess \
+                or not uri.startswith(('http://', 'https://')) \
+                or uri.startswith(HTTPSERVER_BASE_URL):
+            return False
+        if response is not None:
+            # A redirect, e.g. back to a resource too large for the proxy.
+            return False
+        message = request.get_message()
+        if message is None or message.get_property('method') != 'GET':
+            return False
+        # Documents loaded into frames aren't subresources.
+        source = frame.get_provisional_data_source()
+        return source is None or source.get_initial_request().get_uri() != uri
+
 
     def resource_request_cb(self, view, frame, resource, request, response):
         uri = request.get_property('uri')
-        uri = extend_querystring(uri, {'instance': self.widget_ref().instance_id})
+        if self.is_proxied(frame, request, response):
+            uri = '{0}/proxy?{1}'.format(HTTPSERVER_BASE_URL, urllib.urlencode({'url': uri}))
+        if 'v' not in urlparse.parse_qs(urlparse.urlparse(uri).query):
+            # Content-versioned URLs are shared by all instances.
+            uri = extend_querystring(uri, {'instance': self.widget_ref().instance_id})
+
+        if self.inprocess and uri.startswith(HTTPSERVER_BASE_URL):
+            if urlparse.urlparse(uri).path.startswith('/data/'):
+                body = None
+            else:
+                status, headers, body = self.fetch_inprocess(uri, INPROCESS_MAX_SIZE)
+            if body is None:
+                # Files below /data and files too large to be passed around
+                # in memory are loaded over HTTP, from wherever it listens.
+                server = self.widget_ref().__melange_ref__().server
+                uri = server.base_url + uri[len(HTTPSERVER_BASE_URL):]
+            elif 200 <= status < 300:
+                mimetype = headers.get('Content-Type', 'application/octet-stream').strip()
+                if mimetype == 'text/css':
+                    # Relative references can't be resolved against a data URI.
+                    body = rebase_css_urls(body, uri)
+                uri = 'data:{0};base64,{1}'.format(mimetype, base64.b64encode(body))
+            else:
+                uri = 'about:blank'
+
         request.set_property('uri', uri)
 
 
@@ -403,10 +488,31 @@ class Widget(gobject.GObject, cream.Component):
                                           themes=self.__melange_ref__().themes)
         self.config.connect('field-value-changed', self.configuration_value_changed_cb)
 
+        # Skin, data and theme resolved for the HTTP server:
+        self._resolved = {}
+
         self.load()
 
 
+    def _memoized(self, key, resolve):
+
+        value = self._resolved.get(key)
+        if value is None:
+            value = self._resolved[key] = resolve()
+        return value
+
+
+    def invalidate_resolved(self):
+        """ Forget the resolved skin, data and theme of this widget. """
+
+        self._resolved = {}
+
+
     def get_data_path(self):
+        return self._memoized('data', self._find_data_path)
+
+
+    def _find_data_path(self):
 
         data_path = os.path.join(self.context.get_user_path(), 'data/shared')
         if not os.path.isdir(data_path):
@@ -421,7 +527,7 @@ class Widget(gobject.GObject, cream.Component):
 
 
     def get_skin_path(self):
-        return self.get_skin_path_by_id(self.config.widget_skin)
+        return self._memoized('skin', lambda: self.get_skin_path_by_id(self.config.widget_skin))
 
 
     def get_skin_path_by_id(self, skin_id):
@@ -432,6 +538,10 @@ class Widget(gobject.GObject, cream.Component):
         )
 
     def get_current_theme(self):
+        return self._memoized('theme', self._find_current_theme)
+
+
+    def _find_current_theme(self):
         theme_id = self.config.widget_theme
         if theme_id == 'use.the.fucking.global.settings.and.suck.my.Dick':
             theme_id = self.__melange_ref__().config.default_theme
@@ -503,6 +613,7 @@ class Widget(gobject.GObject, cream.Component):
     def reload(self):
         """ Reload the widget. Really? Yeah. """
 
+        self.invalidate_resolved()
         self.emit('reload-request')
 
 
@@ -553,6 +664,7 @@ class Widget(gobject.GObject, cream.Component):
 
     def configuration_value_changed_cb(self, source, key, value):
 
+        self.invalidate_resolved()
         if key == 'widget_theme' or key == 'widget_skin':
             self.reload()
 
@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import time
+import threading
+import traceback
+from collections import deque
+
+from melange.stats import Histogram
+from melange.common import API_WORKERS, API_QUEUE_SIZE, API_CONCURRENCY_PER_WIDGET
+
+
+class PoolFull(RuntimeError):
+    """ Raised when a task is submitted to a `WorkerPool` whose queue is full. """
+
+
+class _Task(object):
+
+    __slots__ = ('owner', 'func', 'args', 'done', 'submitted')
+
+    def __init__(self, owner, func, args, done):
+
+        self.owner = owner
+        self.func = func
+        self.args = args
+        self.done = done
+        self.submitted = time.time()
+
+
+class WorkerPool(object):
+    """
+    A fixed number of worker threads shared by all widgets. Every owner (a
+    widget's API) may have at most `per_owner` tasks running at once; its
+    further tasks wait in its own queue, so a busy widget can't occupy all
+    workers. Tasks submitted while `max_queued` tasks are waiting are
+    rejected.
+    """
+
+    def __init__(self, workers=API_WORKERS, max_queued=API_QUEUE_SIZE,
+                 per_owner=API_CONCURRENCY_PER_WIDGET):
+
+        self.workers = workers
+        self.max_queued = max_queued
+        self.per_owner = per_owner
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.wait_time = Histogram()
+
+        self._ready = deque()
+        self._waiting = {}
+        self._running = {}
+        self._queued = 0
+        self._threads = []
+        self._condition = threading.Condition()
+
+
+    def submit(self, owner, func, args=(), done=None):
+        """
+        Run ``func(*args)`` in a worker thread.
+
+        :param owner: The object the task is accounted to.
+        :param done: Function called with the result (`None` if `func`
+                     raised an exception) in the worker thread.
+
+        :raises PoolFull: If too many tasks are queued.
+        """
+
+        task = _Task(owner, func, args, done)
+
+        with self._condition:
+            if self._queued >= self.max_queued:
+                self.rejected += 1
+                raise PoolFull('{0} calls are queued already'.format(self._queued))
+
+            self.submitted += 1
+            self._queued += 1
+            self.max_depth = max(self.max_depth, self._queued)
+
+            if self._running.get(owner, 0) < self.per_owner:
+                self._running[owner] = self._running.get(owner, 0) + 1
+                self._ready.append(task)
+                self._condition.notify()
+            else:
+                self._waiting.setdefault(owner, deque()).append(task)
+
+            if len(self._threads) < self.workers and len(self._threads) < self._queued + self._busy():
+                thread = threading.Thread(target=self._work, name='melange-worker-{0}'.format(len(self._threads)))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+
+
+    def _busy(self):
+        return sum(self._running.itervalues()) - len(self._ready)
+
+
+    def _work(self):
+
+        while True:
+            with self._condition:
+                while not self._ready:
+                    self._condition.wait()
+                task = self._ready.popleft()
+                self._queued -= 1
+                self.wait_time.add(time.time() - task.submitted)
+
+            try:
+                result = task.func(*task.args)
+            except Exception:
+                traceback.print_exc()
+                result = None
+                with self._condition:
+                    self.failed += 1
+
+            try:
+                if task.done is not None:
+                    task.done(result)
+            except Exception:
+                traceback.print_exc()
+
+            with self._condition:
+                self.completed += 1
+                waiting = self._waiting.get(task.owner)
+                if waiting:
+                    # The owner's next task takes over its slot.
+                    self._ready.append(waiting.popleft())
+                    if not waiting:
+                        del self._waiting[task.owner]
+                    self._condition.notify()
+                else:
+                    self._running[task.owner] -= 1
+                    if not self._running[task.owner]:
+                        del self._running[task.owner]
+
+
+    def get_stats(self):
+        """
+        Get the pool's counters: queue depth, running tasks and how long
+        tasks waited for a worker.
+
+        :rtype: `dict`
+        """
+
+        with self._condition:
+            return {
+                'workers': len(self._threads),
+                'max_workers': self.workers,
+                'queued': self._queued,
+                'max_queued': self.max_queued,
+                'max_depth': self.max_depth,
+                'running': self._busy(),
+                'owners': len(self._running),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'wait_time': self.wait_time.to_dict()
+            }
+
+
+class InflightCalls(object):
+    """
+    Joins identical calls while one of them is running: the first caller runs
+    the call, the others wait for its result.
+    """
+
+    def __init__(self):
+
+        self.coalesced = 0
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+
+    def join(self, call, done):
+        """
+        Wait for the result of `call`.
+
+        :param call: A hashable description of the call.
+        :param done: Function to pass the result to (may be `None`).
+
+        :return: Whether the caller has to run the call and pass its result
+                 to `finish`.
+        """
+
+        with self._lock:
+            waiting = self._calls.get(call)
+            if waiting is not None:
+                waiting.append(done)
+                self.coalesced += 1
+                return False
+            self._calls[call] = [done]
+            return True
+
+
+    def finish(self, call, result):
+        """ Pass the result of `call` to everybody waiting for it. """
+
+        with self._lock:
+            waiting = self._calls.pop(call, ())
+
+        for done in waiting:
+            if done is None:
+                continue
+            try:
+                done(result)
+            except Exception:
+                traceback.print_exc()
+
+
+    def discard(self, call):
+        """ Forget `call` without passing a result, e.g. if it couldn't be run. """
+
+        with self._lock:
+            self._calls.pop(call, None)
+
+
+    def get_stats(self):
+
+        with self._lock:
+            return {
+                'inflight': len(self._calls),
+                'coalesced': self.coalesced
+            }
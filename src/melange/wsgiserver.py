@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import sys
+import socket
+import traceback
+import urllib
+import threading
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+
+# Seconds an idle keep-alive connection is kept open:
+KEEP_ALIVE_TIMEOUT = 15
+
+# Maximum time a bulk transfer pauses per block in favour of other requests:
+BULK_YIELD_TIMEOUT = 0.05
+
+
+class PriorityGate(object):
+    """
+    Lets bulk transfers step aside while other requests are being served.
+    Bulk transfers call `yield_to_priority` between blocks, which blocks as
+    long as there are priority requests in flight (up to a timeout, so bulk
+    transfers can't starve).
+    """
+
+    def __init__(self):
+
+        self._condition = threading.Condition()
+        self._active = 0
+
+
+    def enter(self):
+
+        with self._condition:
+            self._active += 1
+
+
+    def leave(self):
+
+        with self._condition:
+            self._active -= 1
+            if not self._active:
+                self._condition.notify_all()
+
+
+    def yield_to_priority(self, timeout=BULK_YIELD_TIMEOUT):
+
+        with self._condition:
+            if self._active:
+                self._condition.wait(timeout)
+
+
+class WSGIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ A minimal HTTP/1.1 WSGI request handler supporting keep-alive. """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def do_GET(self):
+        self.run_wsgi()
+
+    do_HEAD = do_POST = do_GET
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def make_environ(self):
+
+        path, _, query = self.path.partition('?')
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'CONTENT_TYPE': self.headers.getheader('content-type', ''),
+            'CONTENT_LENGTH': self.headers.getheader('content-length', ''),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': self.rfile,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+        length = int(environ['CONTENT_LENGTH'] or 0)
+        environ['wsgi.input'] = StringIO(self.rfile.read(length) if length else '')
+
+        for name, value in self.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+
+        return environ
+
+
+    def run_wsgi(self):
+
+        environ = self.make_environ()
+        bulk = environ['PATH_INFO'].startswith(self.server.bulk_prefixes)
+        # Long-lived streams neither hold back bulk transfers nor step aside.
+        priority = not bulk and not environ['PATH_INFO'].startswith(self.server.stream_prefixes)
+        gate = self.server.gate
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get('sent'):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            response['status'] = status
+            response['headers'] = headers
+            return write
+
+        def write(data):
+            if not response.get('sent'):
+                send_headers()
+            if not data or self.command == 'HEAD':
+                return
+            if response['chunked']:
+                self.wfile.write('{0:x}\r\n{1}\r\n'.format(len(data), data))
+            else:
+                self.wfile.write(data)
+
+        def send_headers():
+            status, headers = response['status'], response['headers']
+            code, _, message = status.partition(' ')
+            names = set(name.lower() for name, value in headers)
+            response['chunked'] = 'content-length' not in names and int(code) not in (204, 304) \
+                                  and self.command != 'HEAD'
+            if response['chunked'] and self.request_version != 'HTTP/1.1':
+                # Without chunking, the end of the body is marked by closing.
+                response['chunked'] = False
+                self.close_connection = 1
+
+            self.send_response(int(code), message)
+            for name, value in headers:
+                self.send_header(name, value)
+            if response['chunked']:
+                self.send_header('Transfer-Encoding', 'chunked')
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            response['sent'] = True
+
+        if priority:
+            gate.enter()
+        try:
+            result = self.server.app(environ, start_response)
+            try:
+                for data in result:
+                    if bulk:
+                        gate.yield_to_priority()
+                    write(data)
+                if not response.get('sent'):
+                    send_headers()
+                if response['chunked']:
+                    self.wfile.write('0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except socket.error:
+            self.close_connection = 1
+        except Exception:
+            traceback.print_exc()
+            if response.get('sent'):
+                self.close_connection = 1
+            else:
+                self.send_error(500)
+        finally:
+            if priority:
+                gate.leave()
+
+
+class ThreadedWSGIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A WSGI server handling every connection in its own thread, so a slow
+    transfer never blocks the others.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, app, bulk_prefixes=(), stream_prefixes=()):
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, WSGIRequestHandler)
+
+        self.app = app
+        self.bulk_prefixes = tuple(bulk_prefixes)
+        self.stream_prefixes = tuple(stream_prefixes)
+        self.gate = PriorityGate()
+
+
+def run_bjoern(app, host, port, bulk_prefixes=(), stream_prefixes=()):
+    from bjoern import run
+    run(app, host, port)
+
+
+def run_threaded(app, host, port, bulk_prefixes=(), stream_prefixes=()):
+    ThreadedWSGIServer((host, port), app, bulk_prefixes, stream_prefixes).serve_forever()
+
+
+def start_threaded(app, host, port=0, bulk_prefixes=(), stream_prefixes=()):
+    """
+    Start a `ThreadedWSGIServer` serving from a thread of its own. With
+    `port` 0, a free port is picked.
+
+    :return: The address the server listens on.
+    :rtype: `tuple`
+    """
+
+    server = ThreadedWSGIServer((host, port), app, bulk_prefixes, stream_prefixes)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address
+
+
+BACKENDS = {
+    'bjoern': run_bjoern,
+    'threaded': run_threaded
+}